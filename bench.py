@@ -0,0 +1,166 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import ecom
+
+# Load test for ecom.py: seeds a throwaway database, serves it from an in-process PooledServer on
+# a free port and replays a seeded mix of shopper/admin traffic from concurrent keep-alive clients.
+# Prints throughput and latency percentiles per route as JSON, so runs can be diffed across commits:
+#   python bench.py --products 5000 --clients 32 --requests 500 > before.json
+
+WORDS = ('red blue green black white linen cotton wool leather ceramic steel oak bamboo classic slim '
+         'mug shirt lamp chair table bag scarf bottle jacket boots desk shelf vase rug pillow clock').split()
+
+# route name -> relative weight in the traffic mix
+MIX = {'browse': 30, 'browse_next': 10, 'search': 15, 'product': 25, 'cart_add': 8, 'cart_qty': 4, 'cart': 6, 'admin': 2}
+
+def seed_db(path, products, users, cart_items, addresses, seed):
+    rng = random.Random(seed)
+    ecom.DB_PATH = path
+    ecom.init_db()
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany("INSERT INTO products (name, price, img, description) VALUES (?,?,?,?)",
+                         [(' '.join(rng.sample(WORDS, 3)).title(), round(rng.uniform(2, 300), 2), '',
+                           ' '.join(rng.choices(WORDS, k=rng.randint(8, 30)))) for _ in range(products)])
+        conn.executemany("INSERT INTO users (username, password, role) VALUES (?,?,?)",
+                         [(f'user{u}', 'bench', 'customer') for u in range(users)])
+        conn.executemany("INSERT OR IGNORE INTO carts (username, product_id, quantity) VALUES (?,?,?)",
+                         [(f'user{u}', rng.randint(1, products), rng.randint(1, 3)) for u in range(users) for _ in range(cart_items)])
+        conn.executemany("INSERT INTO addresses (username, address_text) VALUES (?,?)",
+                         [(f'user{u}', f'{rng.randint(1, 999)} {rng.choice(WORDS).title()} St') for u in range(users) for _ in range(addresses)])
+    conn.close()
+
+class Client:
+    def __init__(self, port, rng, products, gzip):
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        self.rng, self.products = rng, products
+        self.headers = {'Accept-Encoding': 'gzip'} if gzip else {}
+        self.cookies = {}   # 'shopper' / 'admin' -> session cookie; one connection serves both
+
+    def request(self, method, path, form=None, as_user='shopper'):
+        body = urllib.parse.urlencode(form) if form else None
+        headers = dict(self.headers, **({'Content-Type': 'application/x-www-form-urlencoded'} if form else {}))
+        if as_user in self.cookies: headers['Cookie'] = self.cookies[as_user]
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse(); response.read()
+        except (OSError, http.client.HTTPException):
+            self.conn.close(); return None
+        if response.getheader('Connection') == 'close': self.conn.close()
+        return response
+
+    def login(self, as_user, user, password):
+        response = self.request('POST', '/login', {'user': user, 'pass': password}, as_user)
+        cookie = response and response.getheader('Set-Cookie')
+        if not cookie: raise SystemExit(f'bench: could not log in as {user}')
+        self.cookies[as_user] = cookie.split(';')[0]
+
+    def step(self, route):
+        rng = self.rng
+        if route == 'browse': response = self.request('GET', '/')
+        elif route == 'browse_next': response = self.request('GET', f'/?after={rng.randint(1, self.products)}')
+        elif route == 'search': response = self.request('GET', '/?' + urllib.parse.urlencode({'q': rng.choice(WORDS)[:rng.randint(2, 6)]}))
+        elif route == 'product': response = self.request('GET', f'/product?id={rng.randint(1, self.products)}')
+        elif route == 'cart_add': response = self.request('POST', '/cart/add', {'product_id': rng.randint(1, self.products)})
+        elif route == 'cart_qty': response = self.request('POST', '/cart/qty', {'product_id': rng.randint(1, self.products), 'change': rng.choice((1, -1))})
+        elif route == 'cart': response = self.request('GET', '/cart')
+        else: response = self.request('GET', '/admin', as_user='admin')
+        return response.status if response else None
+
+def percentile(sorted_values, q):
+    if not sorted_values: return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def run(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        seed_db(os.path.join(tmp, 'shop_data.db'), args.products, args.users, args.cart_items, args.addresses, args.seed)
+
+        class Handler(ecom.ShopHandler):
+            def log_message(self, *a):
+                if args.log: super().log_message(*a)
+
+        server = ecom.PooledServer(('127.0.0.1', 0), Handler, args.workers, args.queue)
+        port = server.server_address[1]
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        routes, weights = list(MIX), list(MIX.values())
+        samples = {route: [] for route in routes}
+        errors = {route: 0 for route in routes}
+        lock = threading.Lock()
+        start_line = threading.Barrier(args.clients + 1)
+
+        def client(i):
+            rng = random.Random(args.seed * 1000 + i)
+            c = Client(port, rng, args.products, args.gzip)
+            try: c.login('shopper', f'user{i % args.users}', 'bench'); c.login('admin', 'admin', 'admin')
+            except BaseException: start_line.abort(); raise
+            plan = rng.choices(routes, weights, k=args.warmup + args.requests)
+            mine, failed = {route: [] for route in routes}, {route: 0 for route in routes}
+            start_line.wait()
+            for n, route in enumerate(plan):
+                t = time.perf_counter()
+                status = c.step(route)
+                elapsed = time.perf_counter() - t
+                if n < args.warmup: continue
+                if status is None or status >= 400: failed[route] += 1
+                else: mine[route].append(elapsed)
+            with lock:
+                for route in routes: samples[route] += mine[route]; errors[route] += failed[route]
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+        for t in threads: t.start()
+        start_line.wait(); began = time.perf_counter()
+        for t in threads: t.join()
+        wall = time.perf_counter() - began
+        server_routes = {route: {'sql_statements': r.sql_count, 'sql_seconds': round(r.sql_time, 6), 'bytes': r.bytes}
+                         for route, r in ecom.METRICS.routes.items()}
+        server.shutdown(); server.server_close()
+
+    report = {'config': {k: v for k, v in vars(args).items() if k != 'log'}, 'python': sys.version.split()[0],
+              'sqlite': sqlite3.sqlite_version, 'wall_seconds': round(wall, 3), 'routes': {}, 'server': server_routes}
+    total = 0
+    for route in routes:
+        values = sorted(samples[route]); total += len(values)
+        report['routes'][route] = {'requests': len(values), 'errors': errors[route], 'rps': round(len(values) / wall, 1),
+                                   'mean_ms': round(1000 * sum(values) / len(values), 3) if values else 0.0,
+                                   **{f'p{q}_ms': round(1000 * percentile(values, q / 100), 3) for q in (50, 90, 95, 99)},
+                                   'max_ms': round(1000 * values[-1], 3) if values else 0.0}
+    report['requests'], report['errors'] = total, sum(errors.values())
+    report['rps'] = round(total / wall, 1)
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Seed a temporary shop database and load-test ecom.py in-process.')
+    parser.add_argument('--products', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--cart-items', type=int, default=3, help='cart lines seeded per user')
+    parser.add_argument('--addresses', type=int, default=1, help='addresses seeded per user')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent keep-alive clients')
+    parser.add_argument('--requests', type=int, default=300, help='measured requests per client')
+    parser.add_argument('--warmup', type=int, default=20, help='unmeasured requests per client before timing starts')
+    parser.add_argument('--workers', type=int, default=ecom.WORKERS)
+    parser.add_argument('--queue', type=int, default=ecom.QUEUE_SIZE)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-gzip', dest='gzip', action='store_false', help="don't send Accept-Encoding: gzip")
+    parser.add_argument('--log', action='store_true', help='keep the per-request access log on stderr')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+    if args.clients > args.workers + args.queue:
+        parser.error('--clients exceeds --workers + --queue; the extra connections would be shed with 503s')
+    report = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f: f.write(report + '\n')
+    else: print(report)
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
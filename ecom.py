@@ -2,18 +2,174 @@ import http.server
 import socketserver
 import sqlite3
 import os
+import contextlib
+import collections
+import hashlib
+import secrets
+import time
+import queue
+import signal
+import socket
+import threading
 import urllib.parse
 import json
+import html
+import re
+import struct
+import zlib
+import functools
+import bisect
+import sys
+import csv
+import io
+import codecs
+import math
+import argparse
 from http import cookies
 
+try: import brotli   # optional: offered as Content-Encoding: br when installed
+except ImportError: brotli = None
+
 # --- CONFIGURATION ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, 'shop_data.db')
 PORT = 8000
+WORKERS = 16        # request threads per process
+QUEUE_SIZE = 64     # accepted connections allowed to wait for a free worker before we answer 503
+PROCESSES = 1       # >1 forks that many servers sharing PORT through SO_REUSEPORT
+
+BUSY_TIMEOUT = 5.0         # seconds a writer waits for the write lock before failing
+CACHED_STATEMENTS = 256    # prepared statements kept per connection
+SESSION_TTL = 30 * 86400   # seconds a login stays valid
+SESSION_CACHE_SIZE = 10000 # identities kept in memory per process
+SESSION_CACHE_TTL = 300    # seconds a cached identity is trusted before sqlite is asked again
+PAGE_SIZE = 24             # products per catalog page
+STREAM_CHUNK = 16384       # bytes gathered before a chunk of a streamed page is written
+KEEPALIVE_TIMEOUT = 5      # seconds an idle HTTP/1.1 connection may hold a worker
+KEEPALIVE_REQUESTS = 100   # responses on one connection before we ask the client to reconnect
+COMPRESS_MIN = 1024        # bodies smaller than this are sent uncompressed
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+RESPONSE_CACHE_BYTES = 32 * 1024 * 1024  # rendered catalog/product pages kept per process
+DEMAND_TOP = 20            # products shown in the admin demand chart
+DEMAND_HISTORY = True      # also record units added/removed per time bucket for trend charts
+DEMAND_BUCKET = 3600       # seconds per history bucket
+DEMAND_HISTORY_DAYS = 90   # history older than this is pruned at startup
+WRITE_BEHIND = False       # queue cart/address writes and commit them in batches (see WriteBehind)
+WRITE_BEHIND_BATCH = 200   # queued writes that trigger an immediate flush
+WRITE_BEHIND_INTERVAL = 0.05  # seconds a queued write may wait before it is committed
+MAX_ADDRESSES = 3
+IMPORT_BATCH = 1000         # product rows written per transaction by a bulk import
+IMPORT_MAX_ERRORS = 100    # bad rows reported one by one; further ones are only counted
+IMPORT_FIELD_LIMIT = 1024 * 1024  # longest CSV field an import accepts (csv's own default is 128 KB)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds, for /metrics
+PROFILE_SLOW = None        # seconds; when set, requests slower than this log their hottest sampled stacks
+PROFILE_INTERVAL = 0.005   # seconds between stack samples while PROFILE_SLOW is set
+
+# --- CONNECTION POOL ---
+# Each worker thread keeps one connection for its whole life, so requests skip connect/close
+# and reuse sqlite's prepared-statement cache. Connections run in autocommit mode: plain reads
+# never open a transaction (WAL lets them run alongside a writer) and anything that needs
+# several statements to be atomic goes through transaction().
+class _Local(threading.local):
+    conn = None
+    sql_count, sql_time = 0, 0.0   # statements run by the current request (see MeteredConnection)
+
+_local = _Local()
+_pool = []
+_pool_lock = threading.Lock()
+
+def db():
+    conn = _local.conn
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT, isolation_level=None, factory=MeteredConnection,
+                               check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+        conn.execute("PRAGMA synchronous=NORMAL")   # WAL only needs fsync at checkpoints
+        conn.execute("PRAGMA cache_size=-16000")    # 16 MB page cache
+        conn.execute("PRAGMA temp_store=MEMORY")
+        _local.conn = conn
+        with _pool_lock: _pool.append(conn)
+    return conn
+
+@contextlib.contextmanager
+def transaction():
+    conn = db()
+    # IMMEDIATE takes the write lock up front instead of failing on a read->write upgrade
+    conn.execute("BEGIN IMMEDIATE")
+    try: yield conn
+    except BaseException: conn.execute("ROLLBACK"); raise
+    conn.execute("COMMIT")
+
+def close_pool():
+    with _pool_lock:
+        for conn in _pool: conn.close()
+        _pool.clear()
+
+# --- SESSIONS ---
+# Login hands out an opaque random token (cookie "sid"); the sessions table maps it to a user.
+# SessionCache keeps token -> (username, role) in memory so most requests never query sqlite.
+# Each process has its own cache: a logout or password change drops entries here right away,
+# other processes notice once their copy reaches SESSION_CACHE_TTL.
+class SessionCache:
+    def __init__(self, size=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL):
+        self.size, self.ttl = size, ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, token):
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry and entry[2] > time.monotonic():
+                self.entries.move_to_end(token); self.hits += 1
+                return {'name': entry[0], 'role': entry[1]}
+            if entry: del self.entries[token]
+            self.misses += 1
+        return None
+
+    def put(self, token, username, role):
+        with self.lock:
+            self.entries[token] = (username, role, time.monotonic() + self.ttl)
+            self.entries.move_to_end(token)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False); self.evictions += 1
+
+    def drop(self, token=None, username=None):
+        with self.lock:
+            if token: self.entries.pop(token, None)
+            if username:
+                for t in [t for t, e in self.entries.items() if e[0] == username]: del self.entries[t]
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self.entries)}
+
+SESSIONS = SessionCache()
+
+def start_session(username):
+    token = secrets.token_urlsafe(32)
+    db().execute("INSERT INTO sessions (token, username, created) VALUES (?,?,?)", (token, username, int(time.time())))
+    return token
+
+def lookup_session(token):
+    user = SESSIONS.get(token)
+    if user: return user
+    res = db().execute('''SELECT users.username, users.role FROM sessions JOIN users ON users.username = sessions.username
+                          WHERE sessions.token=? AND sessions.created > ?''', (token, int(time.time()) - SESSION_TTL)).fetchone()
+    if not res: return None
+    SESSIONS.put(token, res[0], res[1])
+    return {'name': res[0], 'role': res[1]}
+
+def end_sessions(token=None, username=None):
+    # Call with username whenever a user's password or role changes
+    if token: db().execute("DELETE FROM sessions WHERE token=?", (token,))
+    if username: db().execute("DELETE FROM sessions WHERE username=?", (username,))
+    SESSIONS.drop(token, username)
 
 # --- DATABASE INIT ---
 def init_db():
     conn = sqlite3.connect(DB_PATH)
+    conn.execute("PRAGMA journal_mode=WAL")  # persistent: stored in the database file
     c = conn.cursor()
     c.execute('''CREATE TABLE IF NOT EXISTS users 
                  (id INTEGER PRIMARY KEY, username TEXT UNIQUE, password TEXT, role TEXT)''')
@@ -25,11 +181,88 @@ def init_db():
         c.execute("SELECT description FROM products LIMIT 1")
     except sqlite3.OperationalError:
         c.execute("ALTER TABLE products ADD COLUMN description TEXT")
-        
+
+    # Full-text index over name + description. It stores no copy of the text (content=products);
+    # the triggers keep it in step with every insert/update/delete on products.
+    fts_exists = c.execute("SELECT 1 FROM sqlite_master WHERE name='products_fts'").fetchone()
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5
+                 (name, description, content='products', content_rowid='id', prefix='2 3', tokenize='unicode61 remove_diacritics 2')''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+                 INSERT INTO products_fts (rowid, name, description) VALUES (new.id, new.name, new.description); END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+                 INSERT INTO products_fts (products_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF name, description ON products BEGIN
+                 INSERT INTO products_fts (products_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+                 INSERT INTO products_fts (rowid, name, description) VALUES (new.id, new.name, new.description); END''')
+    # Bumped by every write to products, in any process; lets the page cache spot changes it didn't make
+    c.execute("CREATE TABLE IF NOT EXISTS catalog_version (version INTEGER NOT NULL)")
+    if not c.execute("SELECT 1 FROM catalog_version").fetchone():
+        c.execute("INSERT INTO catalog_version (version) VALUES (0)")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS catalog_version_{event.lower()} AFTER {event} ON products BEGIN
+                      UPDATE catalog_version SET version = version + 1; END''')
+    if not fts_exists:
+        c.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+        # Name hits count ten times as much as description hits
+        c.execute("INSERT INTO products_fts (products_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)')")
+
     c.execute('''CREATE TABLE IF NOT EXISTS carts 
                  (id INTEGER PRIMARY KEY, username TEXT, product_id INTEGER, quantity INTEGER)''')
     c.execute('''CREATE TABLE IF NOT EXISTS addresses 
                  (id INTEGER PRIMARY KEY, username TEXT, address_text TEXT)''')
+
+    # Units of each product sitting in carts, kept current by triggers on carts so the admin
+    # report reads a handful of precomputed rows instead of aggregating every cart.
+    demand_exists = c.execute("SELECT 1 FROM sqlite_master WHERE name='cart_demand'").fetchone()
+    c.execute("CREATE TABLE IF NOT EXISTS cart_demand (product_id INTEGER PRIMARY KEY, units INTEGER NOT NULL)")
+    c.execute("CREATE INDEX IF NOT EXISTS cart_demand_units ON cart_demand (units DESC)")
+    if not demand_exists:
+        c.execute("INSERT INTO cart_demand (product_id, units) SELECT product_id, SUM(quantity) FROM carts GROUP BY product_id")
+    c.execute('''CREATE TRIGGER IF NOT EXISTS cart_demand_insert AFTER INSERT ON carts BEGIN
+                 INSERT INTO cart_demand (product_id, units) VALUES (new.product_id, new.quantity)
+                     ON CONFLICT (product_id) DO UPDATE SET units = units + excluded.units; END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS cart_demand_delete AFTER DELETE ON carts BEGIN
+                 UPDATE cart_demand SET units = units - old.quantity WHERE product_id = old.product_id; END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS cart_demand_update AFTER UPDATE OF product_id, quantity ON carts BEGIN
+                 UPDATE cart_demand SET units = units - old.quantity WHERE product_id = old.product_id;
+                 INSERT INTO cart_demand (product_id, units) VALUES (new.product_id, new.quantity)
+                     ON CONFLICT (product_id) DO UPDATE SET units = units + excluded.units; END''')
+    # A deleted product leaves no cart lines behind: ids can be reused by the next insert, which
+    # would otherwise inherit them. Older databases had a trigger that kept them, so it is replaced
+    # and any orphaned lines are dropped (through the carts triggers, which settle cart_demand).
+    c.execute("DROP TRIGGER IF EXISTS cart_demand_product_delete")
+    c.execute('''CREATE TRIGGER cart_demand_product_delete AFTER DELETE ON products BEGIN
+                 DELETE FROM carts WHERE product_id = old.id;
+                 DELETE FROM cart_demand WHERE product_id = old.id; END''')
+    c.execute("DELETE FROM carts WHERE product_id NOT IN (SELECT id FROM products)")
+    c.execute("DELETE FROM cart_demand WHERE product_id NOT IN (SELECT id FROM products)")
+
+    # Optional trend data: net units added to carts per product per DEMAND_BUCKET seconds.
+    # Recreated on every start so a changed bucket size or switch takes effect.
+    c.execute('''CREATE TABLE IF NOT EXISTS cart_demand_history
+                 (bucket INTEGER, product_id INTEGER, units INTEGER NOT NULL, PRIMARY KEY (bucket, product_id)) WITHOUT ROWID''')
+    bucket = f"CAST(strftime('%s', 'now') AS INTEGER) / {int(DEMAND_BUCKET)} * {int(DEMAND_BUCKET)}"
+    for event, rows in (('INSERT', ['new.product_id, new.quantity']), ('DELETE', ['old.product_id, -old.quantity']),
+                        ('UPDATE OF product_id, quantity', ['old.product_id, -old.quantity', 'new.product_id, new.quantity'])):
+        name = 'cart_demand_history_' + event.split()[0].lower()
+        c.execute(f"DROP TRIGGER IF EXISTS {name}")
+        if DEMAND_HISTORY:
+            inserts = ''.join(f'''INSERT INTO cart_demand_history (bucket, product_id, units) VALUES ({bucket}, {row})
+                                  ON CONFLICT (bucket, product_id) DO UPDATE SET units = units + excluded.units;''' for row in rows)
+            c.execute(f"CREATE TRIGGER {name} AFTER {event} ON carts BEGIN {inserts} END")
+    c.execute("DELETE FROM cart_demand_history WHERE bucket < ?", (int(time.time()) - DEMAND_HISTORY_DAYS * 86400,))
+    # One row per (user, product). Older databases may hold duplicates from the old
+    # SELECT-then-INSERT cart code: fold them into the first row before adding the constraint.
+    if not c.execute("SELECT 1 FROM sqlite_master WHERE name='carts_user_product'").fetchone():
+        c.execute('''UPDATE carts SET quantity = (SELECT SUM(quantity) FROM carts dup WHERE dup.username = carts.username AND dup.product_id = carts.product_id)
+                     WHERE id IN (SELECT MIN(id) FROM carts GROUP BY username, product_id HAVING COUNT(*) > 1)''')
+        c.execute("DELETE FROM carts WHERE id NOT IN (SELECT MIN(id) FROM carts GROUP BY username, product_id)")
+        c.execute("CREATE UNIQUE INDEX carts_user_product ON carts (username, product_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS addresses_username ON addresses (username)")
+    c.execute('''CREATE TABLE IF NOT EXISTS sessions
+                 (token TEXT PRIMARY KEY, username TEXT, created INTEGER) WITHOUT ROWID''')
+    c.execute("CREATE INDEX IF NOT EXISTS sessions_username ON sessions (username)")
+    c.execute("DELETE FROM sessions WHERE created < ?", (int(time.time()) - SESSION_TTL,))
     
     c.execute("SELECT * FROM users WHERE username='admin'")
     if not c.fetchone():
@@ -38,22 +271,630 @@ def init_db():
     conn.commit()
     conn.close()
 
+# --- CATALOG SEARCH ---
+def fts_query(text):
+    # Every word must match as a prefix ("lapt sta" finds "Laptop Stand"); \w+ words need no escaping
+    return ' '.join(f'"{w}"*' for w in re.findall(r'\w+', text))
+
+def search_products(text, after='', limit=PAGE_SIZE):
+    # Keyset pagination: the cursor is the sort key of the last row shown ("id" when browsing,
+    # "rank:id" when searching), so every page is an index seek however deep the user goes.
+    # Returns (rows, cursor for the next page or None).
+    match = fts_query(text)
+    try:
+        if match:
+            rank, last_id = after.split(':') if after else ('-inf', '0')
+            rows = db().execute('''SELECT products.id, products.name, products.price, products.img, products.description, products_fts.rank
+                                   FROM products_fts JOIN products ON products.id = products_fts.rowid
+                                   WHERE products_fts MATCH ? AND (products_fts.rank > ? OR (products_fts.rank = ? AND products.id > ?))
+                                   ORDER BY products_fts.rank, products.id LIMIT ?''',
+                                (match, float(rank), float(rank), int(last_id), limit + 1)).fetchall()
+        else:
+            rows = db().execute("SELECT id, name, price, img, description FROM products WHERE id > ? ORDER BY id LIMIT ?",
+                                (int(after or 0), limit + 1)).fetchall()
+    except (ValueError, OverflowError):  # malformed cursor, or an id sqlite can't bind: start over
+        return search_products(text, '', limit)
+    if len(rows) <= limit: return rows, None
+    last = rows[limit - 1]
+    return rows[:limit], (f'{last[5]!r}:{last[0]}' if match else str(last[0]))
+
+# --- CATALOG IMPORT/EXPORT ---
+# CSV or JSONL with the columns below. Rows with an id update that product (so an export can be
+# edited and loaded back); rows without one are added. Both directions stream: export reads off
+# the cursor, import parses line by line and commits every IMPORT_BATCH rows, so neither holds the
+# file in memory and other writers get the lock between batches.
+PRODUCT_FIELDS = ('id', 'name', 'price', 'img', 'description')
+PRODUCT_UPSERT = """INSERT INTO products (id, name, price, img, description) VALUES (?,?,?,?,?)
+                    ON CONFLICT(id) DO UPDATE SET name = excluded.name, price = excluded.price, img = excluded.img, description = excluded.description"""
+
+def catalog_format(filename, default='csv'):
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.ndjson')) else 'csv' if filename.lower().endswith('.csv') else default
+
+def export_products(fmt='csv'):
+    rows = db().execute("SELECT id, name, price, img, description FROM products ORDER BY id")
+    if fmt == 'jsonl':
+        for row in rows: yield (json.dumps(dict(zip(PRODUCT_FIELDS, row))) + '\n').encode()
+        return
+    buf = io.StringIO(); out = csv.writer(buf)
+    out.writerow(PRODUCT_FIELDS)
+    for row in rows:
+        out.writerow(row)
+        if buf.tell() >= STREAM_CHUNK: yield buf.getvalue().encode(); buf.seek(0); buf.truncate()
+    yield buf.getvalue().encode()
+
+def product_row(record):
+    if not isinstance(record, dict): raise ValueError('expected an object')
+    name = str(record.get('name') or '').strip()
+    if not name: raise ValueError('name is required')
+    try: price = float(record.get('price'))
+    except (TypeError, ValueError, OverflowError): raise ValueError(f"bad price {record.get('price')!r}") from None
+    if not math.isfinite(price) or price < 0: raise ValueError(f'bad price {price!r}')
+    pid = record.get('id')
+    if pid in (None, ''): pid = None
+    elif not re.fullmatch(r'[0-9]+', str(pid)) or not 1 <= int(pid) <= 2**63 - 1: raise ValueError(f'bad id {pid!r}')
+    return (pid and int(pid), name, price, str(record.get('img') or ''), str(record.get('description') or ''))
+
+def parse_products(lines, fmt='csv'):
+    # lines: iterable of bytes; yields (line number, row tuple or the error message)
+    text = codecs.iterdecode(lines, 'utf-8-sig', errors='replace')
+    if fmt == 'jsonl':
+        for n, line in enumerate(text, 1):
+            if not line.strip(): continue
+            try: yield n, product_row(json.loads(line))
+            except (ValueError, RecursionError) as e: yield n, str(e)
+        return
+    csv.field_size_limit(IMPORT_FIELD_LIMIT)
+    reader = csv.DictReader(text)
+    try:
+        if 'name' not in (reader.fieldnames or ()) or 'price' not in reader.fieldnames:
+            yield 1, f"header must name the columns, including name and price (any of {', '.join(PRODUCT_FIELDS)})"; return
+        for record in reader:
+            try: yield reader.line_num, product_row(record)
+            except ValueError as e: yield reader.line_num, str(e)
+    except csv.Error as e:
+        # The reader may have lost track of quoting, so nothing after this point can be trusted
+        yield reader.line_num, f'{e}; the rest of the file was not read'
+
+def import_products(lines, fmt='csv', batch_size=IMPORT_BATCH):
+    # Yields ('error', {'line', 'message'}) per bad row, ('progress', counts) per committed batch
+    # and finally ('done', counts)
+    counts, batch = {'rows': 0, 'imported': 0, 'failed': 0}, []   # batch: [(line, row)]
+    def failed(line, message):
+        counts['failed'] += 1
+        if counts['failed'] <= IMPORT_MAX_ERRORS: yield 'error', {'line': line, 'message': message}
+    def commit():
+        try:
+            with transaction() as conn: conn.executemany(PRODUCT_UPSERT, [row for _, row in batch])
+            counts['imported'] += len(batch)
+        except sqlite3.OperationalError as e:
+            # Locked or out of space: the whole batch is lost, retrying it row by row won't help
+            counts['failed'] += len(batch)
+            yield 'error', {'line': batch[0][0], 'message': f'lines {batch[0][0]}-{batch[-1][0]} not imported: {e}'}
+        except (sqlite3.Error, OverflowError):
+            # Some row sqlite won't take: redo the batch a row at a time so only that row fails
+            for line, row in batch:
+                try:
+                    with transaction() as conn: conn.execute(PRODUCT_UPSERT, row)
+                    counts['imported'] += 1
+                except (sqlite3.Error, OverflowError) as e: yield from failed(line, str(e))
+        batch.clear()
+    for line, row in parse_products(lines, fmt):
+        counts['rows'] += 1
+        if isinstance(row, str): yield from failed(line, row); continue
+        batch.append((line, row))
+        if len(batch) >= batch_size: yield from commit(); yield 'progress', dict(counts)
+    if batch: yield from commit()
+    yield 'done', counts
+
+# --- CARTS ---
+# Adds to (or creates) a cart line; only for products that exist
+CART_UPSERT = '''INSERT INTO carts (username, product_id, quantity) SELECT ?, id, ? FROM products WHERE id = ?
+                 ON CONFLICT (username, product_id) DO UPDATE SET quantity = quantity + excluded.quantity'''
+CART_SET = '''INSERT INTO carts (username, product_id, quantity) SELECT ?, id, ? FROM products WHERE id = ?
+              ON CONFLICT (username, product_id) DO UPDATE SET quantity = excluded.quantity'''
+
+def parse_id(text):
+    # Form/query ids: int or None. ASCII digits only and short enough that sqlite can bind the result
+    return int(text) if re.fullmatch(r'-?[0-9]{1,18}', text) else None
+
+def bounded_int(value, low, high):
+    # JSON integers only (no floats, Infinity, strings or booleans), within what sqlite can store
+    # and a cart can sensibly hold
+    if not isinstance(value, int) or isinstance(value, bool): raise ValueError(f'{value!r} is not an integer')
+    if not low <= value <= high: raise ValueError(f'{value!r} is out of range')
+    return value
+
+def parse_cart_changes(payload):
+    # {"changes": [{"product_id": 3, "change": -1}, {"product_id": 5, "quantity": 2}, ...]} -> [(pid, kind, n)]
+    # Raises ValueError/KeyError/TypeError on malformed input.
+    return [(bounded_int(ch['product_id'], 1, 2**63 - 1), 'set', bounded_int(ch['quantity'], -10**9, 10**9)) if 'quantity' in ch
+            else (bounded_int(ch['product_id'], 1, 2**63 - 1), 'change', bounded_int(ch['change'], -10**9, 10**9))
+            for ch in payload['changes']]
+
+CART_LINES = '''SELECT products.name, products.price, carts.quantity, products.img, products.id, products.description
+                FROM carts JOIN products ON carts.product_id = products.id WHERE carts.username = ? ORDER BY carts.id'''
+
+def change_cart(username, changes):
+    # changes: [(product_id, 'change', n) or (product_id, 'set', n)]; lines that drop below 1 are removed
+    if WRITE_QUEUE: WRITE_QUEUE.change_cart(username, changes); return
+    with transaction() as conn:
+        for pid, kind, n in changes:
+            if kind == 'set' and n < 1: conn.execute("DELETE FROM carts WHERE username = ? AND product_id = ?", (username, pid))
+            else: conn.execute(CART_SET if kind == 'set' else CART_UPSERT, (username, n, pid))
+        conn.execute("DELETE FROM carts WHERE username = ? AND quantity < 1", (username,))
+
+def cart_lines(username):
+    # (name, price, quantity, img, product_id, description) per line, including writes still queued
+    if WRITE_QUEUE: return WRITE_QUEUE.cart_lines(username)
+    return db().execute(CART_LINES, (username,)).fetchall()
+
+def cart_summary(username):
+    items = [{'product_id': l[4], 'quantity': l[2], 'line_total': round(l[1] * l[2], 2)} for l in cart_lines(username)]
+    return {'items': items, 'count': sum(i['quantity'] for i in items), 'total': round(sum(i['line_total'] for i in items), 2)}
+
+# --- ADDRESSES ---
+def address_rows(username):
+    if WRITE_QUEUE: return WRITE_QUEUE.address_rows(username)
+    return db().execute("SELECT id, address_text FROM addresses WHERE username = ? ORDER BY id", (username,)).fetchall()
+
+def add_address(username, text):
+    if WRITE_QUEUE: WRITE_QUEUE.set_address(username, None, text); return
+    with transaction() as conn:
+        count = conn.execute("SELECT count(*) FROM addresses WHERE username=?", (username,)).fetchone()[0]
+        if count < MAX_ADDRESSES: conn.execute("INSERT INTO addresses (username, address_text) VALUES (?, ?)", (username, text))
+
+def edit_address(username, aid, text):
+    if WRITE_QUEUE: WRITE_QUEUE.set_address(username, aid, text); return
+    db().execute("UPDATE addresses SET address_text=? WHERE id=? AND username=?", (text, aid, username))
+
+def delete_address(username, aid):
+    if WRITE_QUEUE: WRITE_QUEUE.set_address(username, aid, None); return
+    db().execute("DELETE FROM addresses WHERE id=? AND username=?", (aid, username))
+
+# --- WRITE-BEHIND QUEUE ---
+# Under heavy cart traffic every click committing its own transaction makes the sqlite write
+# lock the bottleneck. With WRITE_BEHIND on, cart and address writes only update per-user
+# pending state here (the latest quantity per cart line, the latest text per address) and a
+# committer thread writes everything in one transaction once WRITE_BEHIND_BATCH writes are
+# queued or WRITE_BEHIND_INTERVAL has passed. Reads merge the pending state over sqlite, so a
+# user always sees their own writes. The queue is per process: with PROCESSES > 1 another
+# process may serve the next request before the flush, i.e. up to WRITE_BEHIND_INTERVAL late.
+class WriteBehind:
+    def __init__(self, batch=WRITE_BEHIND_BATCH, interval=WRITE_BEHIND_INTERVAL):
+        self.batch, self.interval = batch, interval
+        # Guards the in-memory state only; sqlite is read and written outside it (see flush)
+        self.lock = threading.Condition()
+        self.carts = {}      # username -> {product_id: quantity}, 0 = remove the line
+        self.addresses = {}  # username -> {address id: text}, None = delete, negative ids = not inserted yet
+        self.flushing_carts, self.flushing_addresses = {}, {}  # the batch being committed, still read as pending
+        self.inserted = {}   # negative id -> real id, for pages rendered before the flush
+        self.next_id = -1
+        self.generation = 0  # bumped at every commit; a read of sqlite that straddles one is redone
+        self.pending = self.flushing = self.flushes = self.flushed = 0
+        self.closing = False
+        self.thread = None
+
+    def queued(self):
+        # Caller holds self.lock
+        self.pending += 1
+        if not (self.thread and self.thread.is_alive()):
+            self.thread = threading.Thread(target=self.run, daemon=True); self.thread.start()
+        self.lock.notify()
+
+    def overlay(self, username, pending, flushing):
+        # Caller holds self.lock: writes not in sqlite yet, newest last
+        merged = dict(flushing.get(username, {}))
+        merged.update(pending.get(username, {}))
+        return merged
+
+    def change_cart(self, username, changes):
+        while True:
+            with self.lock: generation, known = self.generation, self.overlay(username, self.carts, self.flushing_carts)
+            stored = {pid: db().execute("SELECT (SELECT quantity FROM carts WHERE username = ? AND product_id = ?), EXISTS (SELECT 1 FROM products WHERE id = ?)",
+                                        (username, pid, pid)).fetchone() for pid, _, _ in changes if pid not in known}
+            with self.lock:
+                if generation != self.generation: continue
+                known = self.overlay(username, self.carts, self.flushing_carts)
+                lines = self.carts.setdefault(username, {})
+                for pid, kind, n in changes:
+                    if pid in lines or pid in known: qty = lines.get(pid, known.get(pid))
+                    else:
+                        qty, exists = stored[pid]
+                        if not (qty or exists): continue
+                        qty = qty or 0
+                    lines[pid] = max(0, n if kind == 'set' else qty + n)
+                    self.queued()
+                return
+
+    def cart_lines(self, username):
+        while True:
+            with self.lock: generation = self.generation
+            lines = {l[4]: l for l in db().execute(CART_LINES, (username,))}
+            with self.lock:
+                if generation != self.generation: continue
+                pending = self.overlay(username, self.carts, self.flushing_carts)
+            for pid, qty in pending.items():
+                if qty < 1: lines.pop(pid, None)
+                elif pid in lines: lines[pid] = lines[pid][:2] + (qty,) + lines[pid][3:]
+                else:
+                    row = db().execute("SELECT name, price, ?, img, id, description FROM products WHERE id = ?", (qty, pid)).fetchone()
+                    if row: lines[pid] = row
+            return list(lines.values())
+
+    def merge_addresses(self, username, rows):
+        # Caller holds self.lock; rows: {id: text} as read from sqlite
+        for aid, text in self.overlay(username, self.addresses, self.flushing_addresses).items():
+            if text is None: rows.pop(aid, None)
+            elif aid > 0 and aid not in rows: continue  # deleted elsewhere
+            else: rows[aid] = text
+        return rows
+
+    def stored_addresses(self, username):
+        return dict(db().execute("SELECT id, address_text FROM addresses WHERE username = ? ORDER BY id", (username,)).fetchall())
+
+    def set_address(self, username, aid, text):
+        # aid None adds an address; text None deletes one
+        while True:
+            with self.lock: generation = self.generation
+            rows = self.stored_addresses(username)
+            with self.lock:
+                if generation != self.generation: continue
+                current = self.merge_addresses(username, rows)
+                if aid is None:
+                    if len(current) >= MAX_ADDRESSES: return
+                    aid, self.next_id = self.next_id, self.next_id - 1
+                else:
+                    aid = self.inserted.get(aid, aid)
+                    if aid not in current: return
+                pending = self.addresses.setdefault(username, {})
+                if aid < 0 and text is None and aid not in self.flushing_addresses.get(username, {}): pending.pop(aid, None)
+                else: pending[aid] = text
+                self.queued()
+                return
+
+    def address_rows(self, username):
+        while True:
+            with self.lock: generation = self.generation
+            rows = self.stored_addresses(username)
+            with self.lock:
+                if generation == self.generation: return list(self.merge_addresses(username, rows).items())
+
+    def flush(self):
+        # The queued writes are swapped out under the lock and written without it, so requests keep
+        # reading and queueing while BEGIN IMMEDIATE waits for sqlite's write lock. Only COMMIT runs
+        # under the lock, together with the generation bump that tells readers sqlite just changed.
+        # A failed batch stays in flushing_* (still visible to readers) and is retried first.
+        with self.lock:
+            if not (self.flushing_carts or self.flushing_addresses):
+                if not self.pending: return
+                self.flushing_carts, self.carts = self.carts, {}
+                self.flushing_addresses, self.addresses = self.addresses, {}
+                self.flushing, self.pending = self.pending, 0
+            carts, addresses = self.flushing_carts, self.flushing_addresses
+        conn = db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for username, lines in carts.items():
+                conn.executemany("DELETE FROM carts WHERE username = ? AND product_id = ?", [(username, pid) for pid, q in lines.items() if q < 1])
+                conn.executemany(CART_SET, [(username, q, pid) for pid, q in lines.items() if q >= 1])
+            inserted = {}
+            for username, changes in addresses.items():
+                conn.executemany("DELETE FROM addresses WHERE id = ? AND username = ?", [(aid, username) for aid, t in changes.items() if t is None])
+                conn.executemany("UPDATE addresses SET address_text = ? WHERE id = ? AND username = ?", [(t, aid, username) for aid, t in changes.items() if aid > 0 and t is not None])
+                for aid, text in changes.items():
+                    if aid < 0 and text is not None: inserted[aid] = conn.execute("INSERT INTO addresses (username, address_text) VALUES (?, ?)", (username, text)).lastrowid
+            with self.lock:
+                conn.execute("COMMIT")
+                self.generation += 1
+                if len(self.inserted) > 10000: self.inserted.clear()
+                self.inserted.update(inserted)
+                self.redirect_inserted(inserted)
+                self.flushing_carts, self.flushing_addresses = {}, {}
+                self.flushes += 1; self.flushed += self.flushing; self.flushing = 0
+        except BaseException:
+            if conn.in_transaction: conn.execute("ROLLBACK")
+            raise
+
+    def redirect_inserted(self, inserted):
+        # Caller holds self.lock: writes queued against an address while it was being inserted
+        for changes in self.addresses.values():
+            for aid in [aid for aid in changes if aid in inserted]:
+                text = changes.pop(aid)
+                changes[inserted[aid]] = text
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not (self.pending or self.flushing) and not self.closing: self.lock.wait()
+                if not (self.pending or self.flushing): return
+                deadline = time.monotonic() + self.interval
+                while self.pending < self.batch and not self.flushing and not self.closing and deadline > time.monotonic():
+                    self.lock.wait(deadline - time.monotonic())
+            try: self.flush()
+            except sqlite3.Error as e:
+                # The batch is kept in flushing_*, so it is retried on the next round
+                sys.stderr.write(f'write-behind flush failed, retrying: {e}\n')
+                time.sleep(self.interval)
+
+    def close(self):
+        # Drain: commit whatever is still queued, then stop the committer
+        with self.lock:
+            self.closing = True; self.lock.notify()
+        if self.thread: self.thread.join()
+        while self.pending or self.flushing: self.flush()
+
+    def stats(self):
+        with self.lock:
+            return {'pending': self.pending + self.flushing, 'flushes': self.flushes, 'flushed': self.flushed}
+
+WRITE_QUEUE = WriteBehind() if WRITE_BEHIND else None
+
+# --- COMPRESSION ---
+# gzip always, br when the brotli module is installed. Cached pages keep their body as a raw
+# deflate stream as well; gzip_splice() puts the per-user header in front of it, so a hit only
+# compresses the header (a few hundred bytes) instead of the whole page.
+ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)
+GZIP_MAGIC = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+@functools.lru_cache(maxsize=256)
+def negotiate(accept_encoding, offered=ENCODINGS):
+    # First of `offered` the client accepts with q > 0, or None for identity
+    accepted = {}
+    for item in accept_encoding.lower().split(','):
+        name, _, params = item.partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try: q = float(value)
+                except ValueError: q = 0.0
+        accepted[name.strip()] = q
+    for encoding in offered:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0: return encoding
+    return None
+
+def compress(body, encoding):
+    if encoding == 'br': return brotli.compress(body, quality=BROTLI_QUALITY)
+    return zlib.compress(body, GZIP_LEVEL, wbits=31)
+
+def compressor(encoding):
+    # For streamed bodies: (feed, finish); whatever feed returns can be sent right away
+    if encoding == 'br':
+        c = brotli.Compressor(quality=BROTLI_QUALITY)
+        return lambda data: c.process(data) + c.flush(), c.finish
+    c = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return lambda data: c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH), c.flush
+
+def deflate(data, final=True):
+    # Raw deflate; a non-final stream ends byte-aligned, so another stream can follow it directly
+    c = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -15)
+    return c.compress(data) + c.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+@functools.lru_cache(maxsize=1024)
+def deflate_header(header):
+    return deflate(header, final=False), zlib.crc32(header)
+
+def gzip_splice(header, body, deflated):
+    head, crc = deflate_header(header)
+    return b''.join((GZIP_MAGIC, head, deflated, struct.pack('<II', zlib.crc32(body, crc), (len(header) + len(body)) & 0xffffffff)))
+
+# --- RESPONSE CACHE ---
+CachedPage = collections.namedtuple('CachedPage', 'body etag product_ids last_page search deflated')
+
+def catalog_version(conn):
+    return conn.execute("SELECT version FROM catalog_version").fetchone()[0]
+
+class ResponseCache:
+    # Rendered page bodies keyed by (path, query, role), bounded by total size with LRU eviction.
+    # Admin edits drop exactly the pages they affect (invalidate); any catalog change made
+    # elsewhere (another process, a bulk import) shows up as a version jump and clears everything.
+    def __init__(self, max_bytes=RESPONSE_CACHE_BYTES):
+        self.max_bytes, self.size = max_bytes, 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.version = None
+        self.hits = self.misses = self.evictions = 0
+
+    def clear(self, version):
+        self.entries.clear(); self.size = 0; self.version = version
+
+    def get(self, key):
+        # Returns (entry or None, catalog version to pass back to put)
+        version = catalog_version(db())
+        with self.lock:
+            if self.version is None or version > self.version: self.clear(version)
+            entry = self.entries.get(key)
+            if entry: self.entries.move_to_end(key); self.hits += 1
+            else: self.misses += 1
+        return entry, version
+
+    def put(self, key, body, version, product_ids=(), last_page=False, search=False):
+        entry = CachedPage(body, hashlib.blake2b(body, digest_size=16).hexdigest(), frozenset(product_ids), last_page, search,
+                           deflate(body) if len(body) >= COMPRESS_MIN else None)
+        with self.lock:
+            # The catalog changed while this page was rendered: serve it, but don't keep it
+            if version != self.version: return entry
+            old = self.entries.pop(key, None)
+            if old: self.size -= self.entry_size(old)
+            self.entries[key] = entry; self.size += self.entry_size(entry)
+            while self.size > self.max_bytes:
+                _, old = self.entries.popitem(last=False); self.size -= self.entry_size(old); self.evictions += 1
+        return entry
+
+    def invalidate(self, version, product_id, added=False, text_changed=False):
+        # version: catalog_version read in the same transaction as the write
+        with self.lock:
+            if self.version is None or version <= self.version: return
+            if version != self.version + 1: self.clear(version); return
+            self.version, product_id = version, int(product_id)
+            for key in [k for k, e in self.entries.items()
+                        if product_id in e.product_ids or (e.search and (added or text_changed)) or (added and e.last_page)]:
+                self.size -= self.entry_size(self.entries.pop(key))
+
+    @staticmethod
+    def entry_size(entry):
+        return len(entry.body) + len(entry.deflated or b'')
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self.entries), 'bytes': self.size}
+
+RESPONSE_CACHE = ResponseCache()
+
+# --- METRICS ---
+# Per-route request counts, latency histograms, SQL statements/time and bytes sent, kept per
+# process and served as Prometheus text at /metrics (with PROCESSES > 1 each scrape sees one
+# process). Requests that end in 404 are counted under route "other" so label values stay bounded.
+class MeteredConnection(sqlite3.Connection):
+    # Times execute() up to the first row; for sorts and aggregates that is nearly all of the work
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        try: return super().execute(sql, params)
+        finally: _local.sql_time += time.perf_counter() - start; _local.sql_count += 1
+
+    def executemany(self, sql, seq):
+        start = time.perf_counter()
+        try: return super().executemany(sql, seq)
+        finally: _local.sql_time += time.perf_counter() - start; _local.sql_count += 1
+
+class RouteStats:
+    __slots__ = ('buckets', 'seconds', 'count', 'statuses', 'sql_count', 'sql_time', 'bytes')
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)   # last one is +Inf
+        self.seconds, self.count, self.statuses = 0.0, 0, collections.Counter()
+        self.sql_count, self.sql_time, self.bytes = 0, 0.0, 0
+
+    def quantile(self, q):
+        # Linear interpolation inside the bucket holding the q-th request, like histogram_quantile()
+        rank, seen, lower = q * self.count, 0, 0.0
+        for bound, n in zip(LATENCY_BUCKETS, self.buckets):
+            if n and seen + n >= rank: return lower + (bound - lower) * (rank - seen) / n
+            seen, lower = seen + n, bound
+        return LATENCY_BUCKETS[-1]
+
+class Metrics:
+    def __init__(self):
+        self.routes = collections.defaultdict(RouteStats)
+        self.lock = threading.Lock()
+
+    def begin(self):
+        _local.sql_count, _local.sql_time = 0, 0.0
+
+    def record(self, route, status, seconds, sent):
+        with self.lock:
+            r = self.routes[route]
+            r.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            r.seconds += seconds; r.count += 1; r.statuses[status] += 1
+            r.sql_count += _local.sql_count; r.sql_time += _local.sql_time; r.bytes += sent
+
+    def exposition(self):
+        lines = []
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}'); lines.append(f'# TYPE {name} {kind}')
+            lines.extend(f'{name}{labels} {value}' for labels, value in samples)
+        with self.lock:
+            routes = sorted(self.routes.items())
+            metric('shop_http_requests_total', 'counter', 'Requests served, by route and status.',
+                   [(f'{{route="{k}",status="{code}"}}', n) for k, r in routes for code, n in sorted(r.statuses.items())])
+            histogram = []
+            for k, r in routes:
+                seen = 0
+                for bound, n in zip(LATENCY_BUCKETS + ('+Inf',), r.buckets):
+                    seen += n; histogram.append((f'_bucket{{route="{k}",le="{bound}"}}', seen))
+                histogram += [(f'_sum{{route="{k}"}}', f'{r.seconds:.6f}'), (f'_count{{route="{k}"}}', r.count)]
+            metric('shop_http_request_duration_seconds', 'histogram', 'Time from request line to last byte written.', histogram)
+            metric('shop_http_request_duration_quantile_seconds', 'gauge', 'p50/p95/p99 estimated from the histogram.',
+                   [(f'{{route="{k}",quantile="{q}"}}', f'{r.quantile(q):.6f}') for k, r in routes for q in (0.5, 0.95, 0.99)])
+            metric('shop_sql_statements_total', 'counter', 'SQL statements executed while serving the route.', [(f'{{route="{k}"}}', r.sql_count) for k, r in routes])
+            metric('shop_sql_seconds_total', 'counter', 'Time spent in sqlite while serving the route.', [(f'{{route="{k}"}}', f'{r.sql_time:.6f}') for k, r in routes])
+            metric('shop_http_response_bytes_total', 'counter', 'Bytes written, headers included.', [(f'{{route="{k}"}}', r.bytes) for k, r in routes])
+        for prefix, stats in (('shop_session_cache', SESSIONS.stats()), ('shop_page_cache', RESPONSE_CACHE.stats()),
+                              ('shop_write_queue', WRITE_QUEUE.stats() if WRITE_QUEUE else {})):
+            for name, value in stats.items():
+                kind = 'gauge' if name in ('entries', 'bytes', 'pending', 'size') else 'counter'
+                metric(f'{prefix}_{name}' + ('_total' if kind == 'counter' else ''), kind, f'{prefix.replace("_", " ")[5:]} {name}.', [('', value)])
+        return ('\n'.join(lines) + '\n').encode()
+
+METRICS = Metrics()
+
+class CountingWriter:
+    def __init__(self, raw): self.raw, self.sent = raw, 0
+    def write(self, data): self.sent += len(data); return self.raw.write(data)
+    def __getattr__(self, name): return getattr(self.raw, name)
+
+class SlowRequestProfiler:
+    # Opt-in (PROFILE_SLOW): while a request runs, a sampler thread records its stack every
+    # PROFILE_INTERVAL; if the request turns out slower than PROFILE_SLOW its hottest stacks are logged.
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval, self.active = interval, {}
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def begin(self):
+        with self.lock:
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, daemon=True); self.thread.start()
+            self.active[threading.get_ident()] = collections.Counter()
+
+    def end(self):
+        with self.lock: return self.active.pop(threading.get_ident(), None)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock: active = list(self.active)
+            stacks = {}
+            for ident in active:
+                frame, stack = frames.get(ident), []
+                while frame and len(stack) < 30:
+                    stack.append(f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} {frame.f_code.co_name}')
+                    frame = frame.f_back
+                if stack: stacks[ident] = tuple(stack)
+            # Counted under the lock, so a request that has already called end() is never touched
+            with self.lock:
+                for ident, stack in stacks.items():
+                    if ident in self.active: self.active[ident][stack] += 1
+
+    @staticmethod
+    def report(samples, top=5):
+        total = sum(samples.values())
+        return ''.join(f'\n  {n}/{total} samples:\n    ' + '\n    '.join(stack) for stack, n in samples.most_common(top))
+
+PROFILER = SlowRequestProfiler() if PROFILE_SLOW else None
+
 # --- HTML TEMPLATES ---
-def get_header(user=None):
-    nav_links = '<a href="/" class="hover:text-indigo-600 transition">Home</a>'
-    if user and user['role'] != 'admin':
-        nav_links += '<a href="/cart" class="hover:text-indigo-600 transition ml-4">🛒 Cart</a>'
-    if user and user['role'] == 'admin':
-        nav_links += '<a href="/admin" class="hover:text-indigo-600 transition ml-4 font-bold text-indigo-600">📊 Admin</a>'
-    
-    auth_link = f'''
-        <a href="/profile" class="text-indigo-600 font-medium hover:underline mr-4">Edit Profile</a>
-        <span class="text-gray-500 mr-2">Hi, {user['name']}</span>
-        <a href="/logout" class="text-red-500 hover:text-red-700">Logout</a>''' if user else '''
-        <a href="/login" class="text-indigo-600 font-medium hover:underline">Login</a>
-        <a href="/register" class="bg-indigo-600 text-white px-4 py-2 rounded-lg hover:bg-indigo-700 transition ml-4">Register</a>'''
-    
-    return f'''
+# Every page is split once, at import, into pre-encoded static byte segments and {{slot}}s, so
+# rendering only escapes the slot values and joins bytes. str values are HTML-escaped; bytes
+# values are fragments that are already rendered (usually another template's output).
+class Template:
+    SLOT = re.compile(r'\{\{(\w+)\}\}')
+
+    def __init__(self, source):
+        parts = self.SLOT.split(source)
+        self.head = parts[0].encode()
+        self.rest = [(name, static.encode()) for name, static in zip(parts[1::2], parts[2::2])]
+
+    def render(self, **values):
+        out = [self.head]
+        for name, static in self.rest:
+            value = values[name]
+            out.append(value if type(value) is bytes else html.escape(str(value)).encode())
+            out.append(static)
+        return b''.join(out)
+
+def js(value):
+    # Data for inline <script>: JSON with every "<" escaped so a product name can't close the tag
+    return json.dumps(value).replace('<', '\\u003c').encode()
+
+def money(value):
+    return f'{value:,.2f}'
+
+PLACEHOLDER_IMG = 'https://via.placeholder.com/400'
+PLACEHOLDER_THUMB = 'https://via.placeholder.com/200'
+
+HEADER = Template('''
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -64,11 +905,11 @@ def get_header(user=None):
         <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
         <link href="https://fonts.googleapis.com/css2?family=Inter:wght@300;400;600&display=swap" rel="stylesheet">
         <style>
-            body {{ font-family: 'Inter', sans-serif; }}
-            .aspect-square-crop {{ position: relative; width: 100%; padding-top: 100%; overflow: hidden; background-color: #f3f4f6; }}
-            .aspect-square-crop img {{ position: absolute; top: 0; left: 0; width: 100%; height: 100%; object-fit: cover; transition: transform 0.5s ease; }}
-            .group:hover .aspect-square-crop img {{ transform: scale(1.05); }}
-            .thumb-crop {{ width: 80px; height: 80px; object-fit: cover; border-radius: 12px; border: 1px solid #e5e7eb; }}
+            body { font-family: 'Inter', sans-serif; }
+            .aspect-square-crop { position: relative; width: 100%; padding-top: 100%; overflow: hidden; background-color: #f3f4f6; }
+            .aspect-square-crop img { position: absolute; top: 0; left: 0; width: 100%; height: 100%; object-fit: cover; transition: transform 0.5s ease; }
+            .group:hover .aspect-square-crop img { transform: scale(1.05); }
+            .thumb-crop { width: 80px; height: 80px; object-fit: cover; border-radius: 12px; border: 1px solid #e5e7eb; }
         </style>
     </head>
     <body class="bg-gray-50 text-gray-800">
@@ -78,134 +919,80 @@ def get_header(user=None):
                     <span class="text-3xl">🛍️</span> Techify
                 </a>
                 <div class="flex items-center space-x-6 font-medium">
-                    {nav_links}
-                    {auth_link}
+                    {{nav_links}}
+                    {{auth_link}}
                 </div>
             </div>
         </nav>
-    '''
+    ''')
+NAV_HOME = '<a href="/" class="hover:text-indigo-600 transition">Home</a>'
+NAV_CUSTOMER = (NAV_HOME + '<a href="/cart" class="hover:text-indigo-600 transition ml-4">🛒 Cart</a>').encode()
+NAV_ADMIN = (NAV_HOME + '<a href="/admin" class="hover:text-indigo-600 transition ml-4 font-bold text-indigo-600">📊 Admin</a>').encode()
+AUTH_USER = Template('''
+        <a href="/profile" class="text-indigo-600 font-medium hover:underline mr-4">Edit Profile</a>
+        <span class="text-gray-500 mr-2">Hi, {{name}}</span>
+        <a href="/logout" class="text-red-500 hover:text-red-700">Logout</a>''')
+ANON_HEADER = HEADER.render(nav_links=NAV_HOME.encode(), auth_link=b'''
+        <a href="/login" class="text-indigo-600 font-medium hover:underline">Login</a>
+        <a href="/register" class="bg-indigo-600 text-white px-4 py-2 rounded-lg hover:bg-indigo-700 transition ml-4">Register</a>''')
 
-class ShopHandler(http.server.BaseHTTPRequestHandler):
-    def get_user(self):
-        cookie = cookies.SimpleCookie(self.headers.get('Cookie'))
-        if 'user' in cookie:
-            username = cookie['user'].value
-            conn = sqlite3.connect(DB_PATH)
-            res = conn.execute("SELECT role FROM users WHERE username=?", (username,)).fetchone()
-            conn.close()
-            return {'name': username, 'role': res[0]} if res else None
-        return None
+def get_header(user=None):
+    if not user: return ANON_HEADER
+    return HEADER.render(nav_links=NAV_ADMIN if user['role'] == 'admin' else NAV_CUSTOMER, auth_link=AUTH_USER.render(name=user['name']))
 
-    def do_GET(self):
-        user = self.get_user()
-        parsed_path = urllib.parse.urlparse(self.path)
-        query_params = urllib.parse.parse_qs(parsed_path.query)
-        
-        if parsed_path.path == '/':
-            search_query = query_params.get('q', [''])[0]
-            conn = sqlite3.connect(DB_PATH)
-            # Fetch specifically to avoid index errors
-            products = conn.execute("SELECT id, name, price, img, description FROM products WHERE name LIKE ?", (f'%{search_query}%',)).fetchall()
-            conn.close()
-            items_html = ""
-            for p in products:
-                # Add to cart is separate at the bottom
-                cart_btn = f'''<form action="/cart/add" method="POST" class="mt-auto">
-                                <input type="hidden" name="product_id" value="{p[0]}">
-                                <button type="submit" class="w-full bg-indigo-600 text-white py-3 rounded-2xl font-semibold hover:bg-indigo-700 transition-all active:scale-95 shadow-lg shadow-indigo-100">Add to Cart</button>
-                               </form>''' if not user or user['role'] != 'admin' else ""
-                
-                items_html += f'''
+CATALOG_TOP = Template('<div class="max-w-6xl mx-auto p-6"><h1 class="text-4xl font-extrabold mb-8 text-gray-900 tracking-tight">Store Collection</h1><form action="/" method="GET" class="mb-10 flex gap-3"><input name="q" value="{{q}}" placeholder="Search products..." class="flex-1 border p-4 rounded-2xl outline-none focus:ring-4 focus:ring-indigo-100 border-gray-200 shadow-sm transition"><button class="bg-indigo-600 text-white px-8 py-4 rounded-2xl font-bold">Search</button></form><div class="grid grid-cols-1 sm:grid-cols-2 md:grid-cols-3 lg:grid-cols-4 gap-8">')
+PRODUCT_CARD = Template('''
                 <div class="bg-white rounded-[2rem] shadow-sm border border-gray-100 hover:shadow-xl transition group overflow-hidden flex flex-col h-full">
-                    <a href="/product?id={p[0]}" class="block">
-                        <div class="aspect-square-crop"><img src="{p[3] if p[3] else "https://via.placeholder.com/400"}"></div>
+                    <a href="/product?id={{id}}" class="block">
+                        <div class="aspect-square-crop"><img src="{{img}}"></div>
                         <div class="p-6 pb-2">
-                            <h3 class="text-lg font-bold text-gray-900 truncate group-hover:text-indigo-600 transition">{p[1]}</h3>
-                            <p class="text-indigo-600 font-extrabold text-xl mt-1">${p[2]:,.2f}</p>
+                            <h3 class="text-lg font-bold text-gray-900 truncate group-hover:text-indigo-600 transition">{{name}}</h3>
+                            <p class="text-indigo-600 font-extrabold text-xl mt-1">${{price}}</p>
                             <p class="text-gray-400 text-xs mt-2 line-clamp-1 italic">Click to view description</p>
                         </div>
                     </a>
                     <div class="p-6 pt-0 mt-auto">
-                        {cart_btn}
+                        {{cart_btn}}
                     </div>
-                </div>'''
-            search_bar = f'<form action="/" method="GET" class="mb-10 flex gap-3"><input name="q" value="{search_query}" placeholder="Search products..." class="flex-1 border p-4 rounded-2xl outline-none focus:ring-4 focus:ring-indigo-100 border-gray-200 shadow-sm transition"><button class="bg-indigo-600 text-white px-8 py-4 rounded-2xl font-bold">Search</button></form>'
-            self.send_html(get_header(user) + f'<div class="max-w-6xl mx-auto p-6"><h1 class="text-4xl font-extrabold mb-8 text-gray-900 tracking-tight">Store Collection</h1>{search_bar}<div class="grid grid-cols-1 sm:grid-cols-2 md:grid-cols-3 lg:grid-cols-4 gap-8">{items_html}</div></div>')
-
-        elif parsed_path.path == '/product':
-            pid = query_params.get('id', [None])[0]
-            conn = sqlite3.connect(DB_PATH)
-            p = conn.execute("SELECT id, name, price, img, description FROM products WHERE id=?", (pid,)).fetchone()
-            conn.close()
-            if not p: self.redirect('/'); return
-
-            cart_btn = f'''
-                <form action="/cart/add" method="POST" class="mt-8">
-                    <input type="hidden" name="product_id" value="{p[0]}">
-                    <button type="submit" class="w-full md:w-auto bg-indigo-600 text-white px-12 py-4 rounded-2xl font-bold shadow-xl shadow-indigo-100 hover:bg-indigo-700 transition active:scale-95">Add to Cart</button>
-                </form>''' if not user or user['role'] != 'admin' else ""
+                </div>''')
+CARD_CART_BTN = Template('''<form action="/cart/add" method="POST" class="mt-auto">
+                                <input type="hidden" name="product_id" value="{{id}}">
+                                <button type="submit" class="w-full bg-indigo-600 text-white py-3 rounded-2xl font-semibold hover:bg-indigo-700 transition-all active:scale-95 shadow-lg shadow-indigo-100">Add to Cart</button>
+                               </form>''')
+NO_PRODUCTS = b'<p class="text-gray-400 text-lg italic col-span-full text-center py-20">No products found.</p>'
+CATALOG_BOTTOM = Template('</div>{{pager}}</div>')
+PAGER = Template('<div class="flex justify-between items-center mt-12">{{first}}{{more}}</div>')
+FIRST_PAGE_LINK = Template('<a href="/?{{query}}" class="text-indigo-600 font-bold hover:underline">← First page</a>')
+NEXT_PAGE_LINK = Template('<a href="/?{{query}}" class="bg-indigo-600 text-white px-8 py-3 rounded-2xl font-bold hover:bg-indigo-700 transition">Next page →</a>')
 
-            content = f'''
+PRODUCT_PAGE = Template('''
             <div class="max-w-6xl mx-auto p-6 mt-10">
                 <div class="bg-white rounded-[2.5rem] shadow-2xl border border-gray-50 overflow-hidden flex flex-col md:flex-row">
                     <div class="md:w-1/2 bg-gray-50 flex items-center justify-center p-8">
-                        <img src="{p[3]}" class="max-w-full h-auto rounded-3xl shadow-lg">
+                        <img src="{{img}}" class="max-w-full h-auto rounded-3xl shadow-lg">
                     </div>
                     <div class="md:w-1/2 p-10 md:p-16 flex flex-col justify-center">
                         <a href="/" class="text-indigo-600 font-bold text-sm uppercase tracking-widest mb-4 inline-block hover:underline">← Back to Home</a>
-                        <h1 class="text-4xl md:text-5xl font-black text-gray-900 mb-4">{p[1]}</h1>
-                        <p class="text-3xl font-bold text-indigo-600 mb-8">${p[2]:,.2f}</p>
+                        <h1 class="text-4xl md:text-5xl font-black text-gray-900 mb-4">{{name}}</h1>
+                        <p class="text-3xl font-bold text-indigo-600 mb-8">${{price}}</p>
                         <div>
                             <h3 class="text-gray-400 text-xs font-bold uppercase tracking-wider mb-2">Description</h3>
-                            <p class="text-gray-600 leading-relaxed text-lg">{p[4] if p[4] else "No description available."}</p>
+                            <p class="text-gray-600 leading-relaxed text-lg">{{description}}</p>
                         </div>
-                        {cart_btn}
+                        {{cart_btn}}
                     </div>
                 </div>
-            </div>'''
-            self.send_html(get_header(user) + content)
-
-        elif parsed_path.path == '/register':
-            error_msg = ""
-            err_type = query_params.get('error', [''])[0]
-            if err_type == 'short_user': error_msg = "Username must be at least 3 characters."
-            elif err_type == 'short_pass': error_msg = "Password must be at least 8 characters."
-            elif err_type == 'exists': error_msg = "Username already exists."
-            self.send_html(get_header(user) + f'<div class="max-w-md mx-auto mt-20 p-10 bg-white rounded-3xl shadow-xl border"><h2 class="text-3xl font-bold text-center mb-6">Create Account</h2><p class="text-red-500 text-center mb-4">{error_msg}</p><form action="/register" method="POST" class="space-y-4"><input name="user" placeholder="Username" class="w-full border p-4 rounded-2xl outline-none" required><input name="pass" type="password" placeholder="Password" class="w-full border p-4 rounded-2xl outline-none" required><button class="w-full bg-indigo-600 text-white py-4 rounded-2xl font-bold hover:bg-indigo-700 transition">Register</button></form></div>')
-
-        elif parsed_path.path == '/login':
-            self.send_html(get_header(user) + '<div class="max-w-md mx-auto mt-20 p-10 bg-white rounded-3xl shadow-xl border"><h2 class="text-3xl font-bold text-center mb-6">Login</h2><form action="/login" method="POST" class="space-y-4"><input name="user" placeholder="Username" class="w-full border p-4 rounded-2xl outline-none" required><input name="pass" type="password" placeholder="Password" class="w-full border p-4 rounded-2xl outline-none" required><button class="w-full bg-indigo-600 text-white py-4 rounded-2xl font-bold hover:bg-indigo-700 transition">Sign In</button></form></div>')
-
-        elif parsed_path.path == '/admin':
-            if not user or user['role'] != 'admin': self.redirect('/login'); return
-            conn = sqlite3.connect(DB_PATH)
-            
-            # Aggregate stats for Graph
-            stats = conn.execute('''SELECT products.name, SUM(carts.quantity) FROM carts JOIN products ON carts.product_id = products.id GROUP BY products.id ORDER BY SUM(carts.quantity) DESC''').fetchall()
-            chart_labels = [s[0] for s in stats]
-            chart_data = [s[1] for s in stats]
+            </div>''')
+PRODUCT_CART_BTN = Template('''
+                <form action="/cart/add" method="POST" class="mt-8">
+                    <input type="hidden" name="product_id" value="{{id}}">
+                    <button type="submit" class="w-full md:w-auto bg-indigo-600 text-white px-12 py-4 rounded-2xl font-bold shadow-xl shadow-indigo-100 hover:bg-indigo-700 transition active:scale-95">Add to Cart</button>
+                </form>''')
 
-            products = conn.execute("SELECT id, name, price, img, description FROM products").fetchall()
-            conn.close()
-            
-            rows = "".join([f'''<tr class="border-b">
-                    <td class="p-4 text-xs">#{p[0]}</td>
-                    <td class="p-4"><img src="{p[3]}" class="thumb-crop"></td>
-                    <td class="p-4 font-bold">{p[1]}</td>
-                    <td class="p-4">
-                        <form action="/admin/update_item" method="POST" class="flex flex-col gap-2">
-                            <input type="hidden" name="id" value="{p[0]}">
-                            <textarea name="desc" class="text-xs border p-2 rounded w-full h-20" placeholder="Description...">{p[4] if p[4] else ""}</textarea>
-                            <div class="flex gap-2 items-center">
-                                <input name="price" type="number" step="0.01" value="{p[2]}" class="border text-xs p-1 rounded w-20">
-                                <button class="bg-indigo-500 text-white text-[10px] px-2 py-1 rounded">Update</button>
-                            </div>
-                        </form>
-                    </td>
-                    <td class="p-4 text-center"><a href="/admin/delete?id={p[0]}" class="text-red-500 font-semibold hover:underline text-xs">Delete</a></td>
-                </tr>''' for p in products])
+REGISTER_PAGE = Template('<div class="max-w-md mx-auto mt-20 p-10 bg-white rounded-3xl shadow-xl border"><h2 class="text-3xl font-bold text-center mb-6">Create Account</h2><p class="text-red-500 text-center mb-4">{{error}}</p><form action="/register" method="POST" class="space-y-4"><input name="user" placeholder="Username" class="w-full border p-4 rounded-2xl outline-none" required><input name="pass" type="password" placeholder="Password" class="w-full border p-4 rounded-2xl outline-none" required><button class="w-full bg-indigo-600 text-white py-4 rounded-2xl font-bold hover:bg-indigo-700 transition">Register</button></form></div>')
+LOGIN_PAGE = b'<div class="max-w-md mx-auto mt-20 p-10 bg-white rounded-3xl shadow-xl border"><h2 class="text-3xl font-bold text-center mb-6">Login</h2><form action="/login" method="POST" class="space-y-4"><input name="user" placeholder="Username" class="w-full border p-4 rounded-2xl outline-none" required><input name="pass" type="password" placeholder="Password" class="w-full border p-4 rounded-2xl outline-none" required><button class="w-full bg-indigo-600 text-white py-4 rounded-2xl font-bold hover:bg-indigo-700 transition">Sign In</button></form></div>'
 
-            self.send_html(get_header(user) + f'''<div class="max-w-6xl mx-auto p-6">
+ADMIN_TOP = Template('''<div class="max-w-6xl mx-auto p-6">
                 <div class="grid grid-cols-1 lg:grid-cols-3 gap-6 mb-10">
                     <div class="lg:col-span-2 bg-white p-8 rounded-3xl border shadow-sm">
                         <h3 class="font-bold mb-4">Cart Demand Report</h3>
@@ -213,153 +1000,584 @@ class ShopHandler(http.server.BaseHTTPRequestHandler):
                     </div>
                     <div class="bg-indigo-600 text-white p-8 rounded-3xl shadow-xl flex flex-col justify-center">
                         <h3 class="opacity-80">Highest Demand</h3>
-                        <p class="text-2xl font-black mt-2">{(chart_labels[0] if chart_labels else "No Data")}</p>
+                        <p class="text-2xl font-black mt-2">{{top_product}}</p>
+                        <p class="text-xs opacity-70 mt-6">Session cache: {{session_hits}} hits / {{session_misses}} misses</p>
+                        <p class="text-xs opacity-70">Page cache: {{page_hits}} hits / {{page_misses}} misses, {{page_kb}} KB</p>
                     </div>
                 </div>
+                {{trend_panel}}
                 <div class="bg-white p-10 rounded-3xl shadow-sm border mb-8"><h2 class="text-2xl font-bold mb-6">Add New Product</h2><form action="/admin/add" method="POST" class="grid grid-cols-1 md:grid-cols-4 gap-4"><input name="name" placeholder="Name" class="border p-3 rounded-xl outline-none" required><input name="price" type="number" step="0.01" placeholder="Price" class="border p-3 rounded-xl outline-none" required><input name="img" placeholder="Image URL" class="border p-3 rounded-xl outline-none"><textarea name="desc" placeholder="Description" class="border p-3 rounded-xl outline-none md:col-span-3"></textarea><button class="bg-indigo-600 text-white py-3 rounded-xl font-bold hover:bg-indigo-700 transition">Add Item</button></form></div>
-                <div class="bg-white p-6 rounded-3xl shadow-sm border overflow-hidden"><h2 class="text-2xl font-bold mb-6 px-4 pt-4 text-gray-900">Inventory</h2><table class="w-full text-left"><thead><tr class="bg-gray-50 border-b uppercase text-xs"><th>ID</th><th>Preview</th><th>Name</th><th>Modify Details</th><th class="text-center">Action</th></tr></thead><tbody>{rows}</tbody></table></div>
+                <div class="bg-white p-10 rounded-3xl shadow-sm border mb-8"><h2 class="text-2xl font-bold mb-6">Bulk Catalog</h2><div class="flex flex-wrap gap-4 items-center"><a href="/admin/export?format=csv" class="border px-4 py-3 rounded-xl font-bold text-sm hover:bg-gray-50">Export CSV</a><a href="/admin/export?format=jsonl" class="border px-4 py-3 rounded-xl font-bold text-sm hover:bg-gray-50">Export JSONL</a><form id="importForm" class="flex gap-4 items-center"><input id="importFile" type="file" accept=".csv,.jsonl,.ndjson" class="text-sm" required><button class="bg-indigo-600 text-white px-6 py-3 rounded-xl font-bold hover:bg-indigo-700 transition">Import</button></form></div><pre id="importResult" class="text-xs mt-4 text-gray-600 whitespace-pre-wrap"></pre></div>
+                <script>
+                    document.getElementById('importForm').onsubmit = async e => {
+                        e.preventDefault();
+                        const file = document.getElementById('importFile').files[0], out = document.getElementById('importResult');
+                        out.textContent = 'Importing ' + file.name + '...';
+                        const format = /\\.(jsonl|ndjson)$/i.test(file.name) ? 'jsonl' : 'csv';
+                        const r = await fetch('/admin/import?format=' + format, { method: 'POST', body: file });
+                        if (!r.ok) { out.textContent = 'Import failed: ' + r.status; return; }
+                        const events = (await r.text()).trim().split('\\n').map(line => JSON.parse(line));
+                        out.textContent = events.map(ev => ev.error ? `line ${ev.error.line}: ${ev.error.message}`
+                            : ev.done ? `Done: ${ev.done.imported} of ${ev.done.rows} rows imported, ${ev.done.failed} failed` : '').filter(Boolean).join('\\n');
+                    };
+                </script>
+                <div class="bg-white p-6 rounded-3xl shadow-sm border overflow-hidden"><h2 class="text-2xl font-bold mb-6 px-4 pt-4 text-gray-900">Inventory</h2><table class="w-full text-left"><thead><tr class="bg-gray-50 border-b uppercase text-xs"><th>ID</th><th>Preview</th><th>Name</th><th>Modify Details</th><th class="text-center">Action</th></tr></thead><tbody>''')
+ADMIN_ROW = Template('''<tr class="border-b">
+                    <td class="p-4 text-xs">#{{id}}</td>
+                    <td class="p-4"><img src="{{img}}" class="thumb-crop"></td>
+                    <td class="p-4 font-bold">{{name}}</td>
+                    <td class="p-4">
+                        <form action="/admin/update_item" method="POST" class="flex flex-col gap-2">
+                            <input type="hidden" name="id" value="{{id}}">
+                            <textarea name="desc" class="text-xs border p-2 rounded w-full h-20" placeholder="Description...">{{description}}</textarea>
+                            <div class="flex gap-2 items-center">
+                                <input name="price" type="number" step="0.01" value="{{price}}" class="border text-xs p-1 rounded w-20">
+                                <button class="bg-indigo-500 text-white text-[10px] px-2 py-1 rounded">Update</button>
+                            </div>
+                        </form>
+                    </td>
+                    <td class="p-4 text-center"><a href="/admin/delete?id={{id}}" class="text-red-500 font-semibold hover:underline text-xs">Delete</a></td>
+                </tr>''')
+ADMIN_BOTTOM = Template('''</tbody></table></div>
             </div>
             <script>
                 const ctx = document.getElementById('cartChart').getContext('2d');
-                new Chart(ctx, {{
+                new Chart(ctx, {
                     type: 'bar',
-                    data: {{
-                        labels: {json.dumps(chart_labels)},
-                        datasets: [{{ label: 'Units in Carts', data: {json.dumps(chart_data)}, backgroundColor: '#6366f1', borderRadius: 10 }}]
-                    }},
-                    options: {{ responsive: true }}
-                }});
+                    data: {
+                        labels: {{labels}},
+                        datasets: [{ label: 'Units in Carts', data: {{data}}, backgroundColor: '#6366f1', borderRadius: 10 }]
+                    },
+                    options: { responsive: true }
+                });
+                {{trend_script}}
             </script>''')
+TREND_PANEL = b'<div class="bg-white p-8 rounded-3xl border shadow-sm mb-10"><h3 class="font-bold mb-4">Demand Trend (last 24h)</h3><canvas id="trendChart" height="80"></canvas></div>'
+TREND_SCRIPT = b'''fetch('/admin/demand.json?hours=24').then(r => r.json()).then(d => new Chart(document.getElementById('trendChart'), {
+                    type: 'line',
+                    data: { labels: d.points.map(p => new Date(p[0] * 1000).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' })),
+                            datasets: [{ label: 'Net units added', data: d.points.map(p => p[1]), borderColor: '#6366f1', tension: 0.3 }] },
+                    options: { responsive: true }
+                }));'''
 
-        elif parsed_path.path == '/cart':
-            if not user or user['role'] == 'admin': self.redirect('/'); return
-            conn = sqlite3.connect(DB_PATH)
-            cart_items = conn.execute('''SELECT products.name, products.price, carts.quantity, products.img, products.id, carts.id, products.description FROM carts JOIN products ON carts.product_id = products.id WHERE carts.username = ?''', (user['name'],)).fetchall()
-            conn.close()
-            items_html = "".join([f'''<div class="flex items-center justify-between border-b border-gray-50 py-6 cart-item" data-price="{item[1]}" id="item-{item[5]}">
+CART_ITEM = Template('''<div class="flex items-center justify-between border-b border-gray-50 py-6 cart-item" data-price="{{price}}" data-product="{{id}}" id="item-{{id}}">
                     <div class="flex items-center">
                         <input type="checkbox" name="selected" class="cart-checkbox mr-6 w-6 h-6 rounded-lg border-gray-200 text-indigo-600" checked onchange="calc()">
-                        <img src="{item[3] if item[3] else "https://via.placeholder.com/200"}" class="thumb-crop mr-6 shadow-sm">
+                        <img src="{{img}}" class="thumb-crop mr-6 shadow-sm">
                         <div class="space-y-1">
-                            <h4 class="font-bold text-gray-900">{item[0]}</h4>
-                            <p class="text-gray-400 text-xs line-clamp-1">{item[6] if item[6] else ''}</p>
+                            <h4 class="font-bold text-gray-900">{{name}}</h4>
+                            <p class="text-gray-400 text-xs line-clamp-1">{{description}}</p>
                             <div class="flex items-center gap-3 pt-2">
-                                <form action="/cart/qty" method="POST"><input type="hidden" name="product_id" value="{item[4]}"><input type="hidden" name="change" value="-1"><button class="w-8 h-8 bg-gray-100 rounded hover:bg-gray-200">-</button></form>
-                                <span class="qty-display font-bold text-sm w-4 text-center">{item[2]}</span>
-                                <form action="/cart/qty" method="POST"><input type="hidden" name="id" value="{item[5]}"><input type="hidden" name="product_id" value="{item[4]}"><input type="hidden" name="change" value="1"><button class="w-8 h-8 bg-gray-100 rounded hover:bg-gray-200">+</button></form>
-                                <a href="/cart/delete?id={item[4]}" class="ml-6 text-xs font-bold text-red-400 hover:text-red-600">Remove</a>
+                                <form action="/cart/qty" method="POST"><input type="hidden" name="product_id" value="{{id}}"><input type="hidden" name="change" value="-1"><button class="w-8 h-8 bg-gray-100 rounded hover:bg-gray-200">-</button></form>
+                                <span class="qty-display font-bold text-sm w-4 text-center">{{quantity}}</span>
+                                <form action="/cart/qty" method="POST"><input type="hidden" name="product_id" value="{{id}}"><input type="hidden" name="change" value="1"><button class="w-8 h-8 bg-gray-100 rounded hover:bg-gray-200">+</button></form>
+                                <a href="/cart/delete?id={{id}}" class="ml-6 text-xs font-bold text-red-400 hover:text-red-600">Remove</a>
                             </div>
                         </div></div>
-                    <div class="font-extrabold text-gray-900 text-lg">${(item[1]*item[2]):,.2f}</div></div>''' for item in cart_items])
+                    <div class="line-total font-extrabold text-gray-900 text-lg">${{line_total}}</div></div>''')
+CART_EMPTY = b'<p class="text-gray-400 text-center py-20 text-lg font-medium italic">Bag is empty.</p>'
+# +/- clicks update the page at once and are sent together to /cart/batch after a short pause;
+# the forms still work as plain POSTs without JavaScript
+CART_PAGE = Template('''<div class="max-w-4xl mx-auto p-10 bg-white mt-10 rounded-[2.5rem] shadow-2xl border border-gray-50"><h2 class="text-4xl font-extrabold mb-10 text-gray-900 tracking-tight">Shopping Cart</h2><div class="divide-y divide-gray-50">{{items}}<div class="mt-12 flex justify-between items-center p-8 bg-gray-50 rounded-[2rem]"><span class="text-xl font-bold text-gray-500">Total</span><span class="text-4xl font-black text-indigo-600" id="total-display">$0.00</span></div><div class="flex gap-6 mt-10"><button onclick="location.reload()" class="flex-1 border py-5 rounded-2xl text-gray-500">Refresh</button><button class="flex-[2] bg-indigo-600 text-white py-5 rounded-2xl font-extrabold shadow-indigo-100 hover:bg-indigo-700 transition-all active:scale-95">Checkout</button></div></div></div><script>function calc(){let t=0;document.querySelectorAll(".cart-item").forEach(i=>{if(i.querySelector(".cart-checkbox").checked){t+=parseFloat(i.dataset.price)*parseInt(i.querySelector(".qty-display").innerText)}});document.getElementById("total-display").innerText="$"+t.toLocaleString(undefined,{minimumFractionDigits:2})}window.onload=calc;</script><script>
+                const pending = {}; let timer = null;
+                const money = v => "$" + v.toLocaleString(undefined, {minimumFractionDigits: 2});
+                document.querySelectorAll('form[action="/cart/qty"]').forEach(f => f.addEventListener("submit", e => {
+                    e.preventDefault();
+                    const item = f.closest(".cart-item"), qty = item.querySelector(".qty-display"), change = parseInt(f.elements.change.value);
+                    qty.innerText = Math.max(0, parseInt(qty.innerText) + change);
+                    pending[item.dataset.product] = (pending[item.dataset.product] || 0) + change;
+                    calc(); clearTimeout(timer); timer = setTimeout(flush, 300);
+                }));
+                function flush() {
+                    const changes = Object.entries(pending).map(([p, c]) => ({product_id: +p, change: c}));
+                    Object.keys(pending).forEach(k => delete pending[k]);
+                    fetch("/cart/batch", {method: "POST", headers: {"Content-Type": "application/json"}, body: JSON.stringify({changes})})
+                        .then(r => r.ok ? r.json() : Promise.reject(r.status))
+                        .then(cart => {
+                            if (Object.keys(pending).length) return;  // newer clicks in flight; their reply will sync
+                            document.querySelectorAll(".cart-item").forEach(i => {
+                                const row = cart.items.find(x => x.product_id == i.dataset.product);
+                                if (!row) { i.remove(); return; }
+                                i.querySelector(".qty-display").innerText = row.quantity;
+                                i.querySelector(".line-total").innerText = money(row.line_total);
+                            });
+                            calc();
+                        })
+                        .catch(() => location.reload());
+                }
+            </script>''')
+
+ADDRESS_ITEM = Template('''<div class="p-4 bg-gray-50 rounded-xl mb-3 border flex justify-between items-center group"><span>{{text}}</span><div class="flex gap-3"><button onclick="document.getElementById('edit-addr-{{id}}').classList.toggle('hidden')" class="text-indigo-400 font-bold">Edit</button><a href="/profile/address/delete?id={{id}}" class="text-red-400 font-bold">×</a></div></div><form id="edit-addr-{{id}}" action="/profile/address/edit" method="POST" class="hidden mb-4 p-4 border rounded-xl bg-white shadow-inner"><input type="hidden" name="id" value="{{id}}"><textarea name="address" class="w-full border p-2 rounded-lg text-sm" required>{{text}}</textarea><button class="bg-indigo-600 text-white px-4 py-2 rounded-xl mt-2 text-xs font-bold">Save Changes</button></form>''')
+ADDRESS_ADD_FORM = b'<form action="/profile/address/add" method="POST" class="mt-6"><textarea name="address" class="w-full border border-gray-200 p-4 rounded-2xl text-sm mb-3" placeholder="New address..." required></textarea><button class="bg-gray-900 text-white text-sm px-6 py-3 rounded-2xl font-bold">Add Address</button></form>'
+ADDRESS_SECTION = Template('<hr class="my-8"><h3 class="font-bold text-lg mb-4 text-gray-900">Addresses (Max {{max}})</h3>{{items}}{{add_form}}')
+PROFILE_PAGE = Template('<div class="max-w-md mx-auto mt-10 p-10 bg-white rounded-[2rem] shadow-2xl border border-gray-100"><h2 class="text-3xl font-extrabold text-center mb-8">Account</h2><form action="/profile/update" method="POST" class="space-y-6 mb-10"><input value="{{name}}" class="w-full p-4 rounded-2xl bg-gray-100" readonly><input name="new_pass" type="password" placeholder="New Password" class="w-full border p-4 rounded-2xl outline-none"><button class="w-full bg-indigo-600 text-white py-4 rounded-2xl font-extrabold transition-all active:scale-95">Save Profile</button></form>{{addresses}}</div>')
+
+class ShopHandler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1 for chunked streaming; every response is therefore framed (Content-Length or chunked)
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+    # Headers and body are separate writes; with Nagle on, the body waits ~40ms for the client's
+    # delayed ACK of the headers on every kept-alive response
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup(); self.served = 0; self.wfile = CountingWriter(self.wfile)
+
+    def parse_request(self):
+        # Called once the request line has arrived, so time spent idle on keep-alive isn't counted
+        self.started = time.perf_counter(); METRICS.begin()
+        if PROFILER: PROFILER.begin()
+        return super().parse_request()
+
+    def handle_one_request(self):
+        self.started, self.status, sent = None, None, self.wfile.sent
+        try: super().handle_one_request()
+        finally:
+            if self.started is not None:
+                elapsed, status = time.perf_counter() - self.started, self.status or 500
+                route = 'other' if status in (400, 404, 414, 431, 501) else urllib.parse.urlparse(self.path).path
+                METRICS.record(route, status, elapsed, self.wfile.sent - sent)
+                samples = PROFILER.end() if PROFILER else None
+                if samples and elapsed >= PROFILE_SLOW:
+                    # Straight to stderr: log_message would escape the newlines
+                    sys.stderr.write(f'slow request {self.command} {self.path} took {elapsed:.3f}s, hottest stacks (innermost first):{PROFILER.report(samples)}\n')
+
+    def send_response(self, code, message=None):
+        self.status = code; super().send_response(code, message)
+
+    def end_headers(self):
+        # A kept-alive connection holds a worker while idle, so hand it back after KEEPALIVE_REQUESTS
+        # responses, or straight away when other connections are queued waiting for a worker
+        self.served += 1
+        if not self.close_connection and (self.served >= KEEPALIVE_REQUESTS or self.server.jobs.qsize()):
+            self.send_header('Connection', 'close')
+        super().end_headers()
+
+    def accepted_encoding(self, offered=ENCODINGS):
+        return negotiate(self.headers.get('Accept-Encoding', ''), offered)
+
+    def session_token(self):
+        cookie = cookies.SimpleCookie(self.headers.get('Cookie'))
+        return cookie['sid'].value if 'sid' in cookie else None
+
+    def get_user(self):
+        token = self.session_token()
+        return lookup_session(token) if token else None
+
+    def set_session(self, token, location):
+        self.send_response(302); self.send_header('Set-Cookie', f'sid={token}; Path=/; HttpOnly; SameSite=Lax; Max-Age={SESSION_TTL}'); self.send_header('Location', location); self.send_header('Content-Length', '0'); self.end_headers()
+
+    def do_GET(self):
+        user = self.get_user()
+        parsed_path = urllib.parse.urlparse(self.path)
+        query_params = urllib.parse.parse_qs(parsed_path.query)
+        
+        if parsed_path.path == '/':
+            search_query = query_params.get('q', [''])[0]
+            after = query_params.get('after', [''])[0]
+            shopper = not user or user['role'] != 'admin'
+
+            # Pages are at most PAGE_SIZE items, so they are rendered whole and cached rather than streamed
+            def render():
+                # Fetch specifically to avoid index errors
+                products, next_cursor = search_products(search_query, after)
+                pager = b''
+                if after or next_cursor:
+                    pager = PAGER.render(first=FIRST_PAGE_LINK.render(query=urllib.parse.urlencode({'q': search_query})) if after else b'<span></span>',
+                                         more=NEXT_PAGE_LINK.render(query=urllib.parse.urlencode({'q': search_query, 'after': next_cursor})) if next_cursor else b'')
+                parts = [CATALOG_TOP.render(q=search_query)]
+                # Add to cart is separate at the bottom
+                parts += [PRODUCT_CARD.render(id=p[0], img=p[3] or PLACEHOLDER_IMG, name=p[1], price=money(p[2]),
+                                              cart_btn=CARD_CART_BTN.render(id=p[0]) if shopper else b'') for p in products]
+                if not products: parts.append(NO_PRODUCTS)
+                parts.append(CATALOG_BOTTOM.render(pager=pager))
+                return parts, [p[0] for p in products], next_cursor is None
+            self.send_cached(user, render, search=bool(fts_query(search_query)))
+
+        elif parsed_path.path == '/product':
+            pid = query_params.get('id', [None])[0]
+
+            def render():
+                p = db().execute("SELECT id, name, price, img, description FROM products WHERE id=?", (pid,)).fetchone()
+                if not p: return None
+
+                cart_btn = PRODUCT_CART_BTN.render(id=p[0]) if not user or user['role'] != 'admin' else b''
+                content = PRODUCT_PAGE.render(img=p[3] or PLACEHOLDER_IMG, name=p[1], price=money(p[2]),
+                                              description=p[4] or "No description available.", cart_btn=cart_btn)
+                return [content], [p[0]], False
+            if not self.send_cached(user, render): self.redirect('/')
+
+        elif parsed_path.path == '/register':
+            error_msg = ""
+            err_type = query_params.get('error', [''])[0]
+            if err_type == 'short_user': error_msg = "Username must be at least 3 characters."
+            elif err_type == 'short_pass': error_msg = "Password must be at least 8 characters."
+            elif err_type == 'exists': error_msg = "Username already exists."
+            self.send_html(get_header(user) + REGISTER_PAGE.render(error=error_msg))
+
+        elif parsed_path.path == '/login':
+            self.send_html(get_header(user) + LOGIN_PAGE)
+
+        elif parsed_path.path == '/admin':
+            if not user or user['role'] != 'admin': self.redirect('/login'); return
+            conn = db()
             
-            script = '<script>function calc(){let t=0;document.querySelectorAll(".cart-item").forEach(i=>{if(i.querySelector(".cart-checkbox").checked){t+=parseFloat(i.dataset.price)*parseInt(i.querySelector(".qty-display").innerText)}});document.getElementById("total-display").innerText="$"+t.toLocaleString(undefined,{minimumFractionDigits:2})}window.onload=calc;</script>'
-            self.send_html(get_header(user) + f'''<div class="max-w-4xl mx-auto p-10 bg-white mt-10 rounded-[2.5rem] shadow-2xl border border-gray-50"><h2 class="text-4xl font-extrabold mb-10 text-gray-900 tracking-tight">Shopping Cart</h2><div class="divide-y divide-gray-50">{items_html if cart_items else '<p class="text-gray-400 text-center py-20 text-lg font-medium italic">Bag is empty.</p>'}<div class="mt-12 flex justify-between items-center p-8 bg-gray-50 rounded-[2rem]"><span class="text-xl font-bold text-gray-500">Total</span><span class="text-4xl font-black text-indigo-600" id="total-display">$0.00</span></div><div class="flex gap-6 mt-10"><button onclick="location.reload()" class="flex-1 border py-5 rounded-2xl text-gray-500">Refresh</button><button class="flex-[2] bg-indigo-600 text-white py-5 rounded-2xl font-extrabold shadow-indigo-100 hover:bg-indigo-700 transition-all active:scale-95">Checkout</button></div></div></div>{script}''')
+            # Stats for Graph, precomputed in cart_demand
+            stats = conn.execute('''SELECT products.name, cart_demand.units FROM cart_demand JOIN products ON cart_demand.product_id = products.id
+                                    WHERE cart_demand.units > 0 ORDER BY cart_demand.units DESC LIMIT ?''', (DEMAND_TOP,)).fetchall()
+            chart_labels = [s[0] for s in stats]
+            chart_data = [s[1] for s in stats]
+
+            session_stats, page_stats = SESSIONS.stats(), RESPONSE_CACHE.stats()
+
+            def page():
+                yield get_header(user)
+                yield ADMIN_TOP.render(top_product=chart_labels[0] if chart_labels else "No Data",
+                                       session_hits=session_stats['hits'], session_misses=session_stats['misses'],
+                                       page_hits=page_stats['hits'], page_misses=page_stats['misses'], page_kb=page_stats['bytes'] // 1024,
+                                       trend_panel=TREND_PANEL if DEMAND_HISTORY else b'')
+                # Inventory rows come straight off the cursor instead of fetchall()
+                for p in conn.execute("SELECT id, name, price, img, description FROM products"):
+                    yield ADMIN_ROW.render(id=p[0], img=p[3] or '', name=p[1], description=p[4] or '', price=p[2])
+                yield ADMIN_BOTTOM.render(labels=js(chart_labels), data=js(chart_data), trend_script=TREND_SCRIPT if DEMAND_HISTORY else b'')
+            self.send_stream(page())
+
+        elif parsed_path.path == '/admin/demand.json':
+            if not user or user['role'] != 'admin': self.send_json({'error': 'forbidden'}, 403); return
+            hours = query_params.get('hours', ['24'])[0]
+            hours = min(int(hours), DEMAND_HISTORY_DAYS * 24) if hours.isdigit() else 24
+            pid = query_params.get('id', [None])[0]
+            now = int(time.time()) // DEMAND_BUCKET * DEMAND_BUCKET
+            since = now - hours * 3600 // DEMAND_BUCKET * DEMAND_BUCKET
+            sql = "SELECT bucket, SUM(units) FROM cart_demand_history WHERE bucket >= ?" + (" AND product_id = ?" if pid else "") + " GROUP BY bucket"
+            units = dict(db().execute(sql, (since, pid) if pid else (since,)).fetchall())
+            # Buckets with no cart activity are reported as 0 so charts get an even time axis
+            self.send_json({'bucket_seconds': DEMAND_BUCKET, 'points': [[b, units.get(b, 0)] for b in range(since, now + 1, DEMAND_BUCKET)]})
+
+        elif parsed_path.path == '/admin/export':
+            if not user or user['role'] != 'admin': self.redirect('/login'); return
+            fmt = 'jsonl' if query_params.get('format', ['csv'])[0] == 'jsonl' else 'csv'
+            self.send_stream(export_products(fmt), 'application/x-ndjson' if fmt == 'jsonl' else 'text/csv; charset=utf-8',
+                             [('Content-Disposition', f'attachment; filename="products.{fmt}"')])
+
+        elif parsed_path.path == '/metrics':
+            if not user or user['role'] != 'admin': self.send_error(403); return
+            self.send_body(METRICS.exposition(), 'text/plain; version=0.0.4; charset=utf-8')
+
+        elif parsed_path.path == '/cart':
+            if not user or user['role'] == 'admin': self.redirect('/'); return
+            cart_items = cart_lines(user['name'])
+            items = b''.join(CART_ITEM.render(price=item[1], id=item[4], img=item[3] or PLACEHOLDER_THUMB, name=item[0], description=item[5] or '',
+                                              quantity=item[2], line_total=money(item[1] * item[2])) for item in cart_items)
+            self.send_html(get_header(user) + CART_PAGE.render(items=items or CART_EMPTY))
 
         elif parsed_path.path == '/profile':
             if not user: self.redirect('/login'); return
-            addr_section = ""
+            addresses = b''
             if user['role'] != 'admin':
-                conn = sqlite3.connect(DB_PATH); addr_list = conn.execute("SELECT id, address_text FROM addresses WHERE username = ?", (user['name'],)).fetchall(); conn.close()
-                addr_html = "".join([f'<div class="p-4 bg-gray-50 rounded-xl mb-3 border flex justify-between items-center group"><span>{a[1]}</span><div class="flex gap-3"><button onclick="document.getElementById(\'edit-addr-{a[0]}\').classList.toggle(\'hidden\')" class="text-indigo-400 font-bold">Edit</button><a href="/profile/address/delete?id={a[0]}" class="text-red-400 font-bold">×</a></div></div><form id="edit-addr-{a[0]}" action="/profile/address/edit" method="POST" class="hidden mb-4 p-4 border rounded-xl bg-white shadow-inner"><input type="hidden" name="id" value="{a[0]}"><textarea name="address" class="w-full border p-2 rounded-lg text-sm" required>{a[1]}</textarea><button class="bg-indigo-600 text-white px-4 py-2 rounded-xl mt-2 text-xs font-bold">Save Changes</button></form>' for a in addr_list])
-                addr_section = f'''<hr class="my-8"><h3 class="font-bold text-lg mb-4 text-gray-900">Addresses (Max 3)</h3>{addr_html}{f'<form action="/profile/address/add" method="POST" class="mt-6"><textarea name="address" class="w-full border border-gray-200 p-4 rounded-2xl text-sm mb-3" placeholder="New address..." required></textarea><button class="bg-gray-900 text-white text-sm px-6 py-3 rounded-2xl font-bold">Add Address</button></form>' if len(addr_list) < 3 else ""}'''
-            self.send_html(get_header(user) + f'''<div class="max-w-md mx-auto mt-10 p-10 bg-white rounded-[2rem] shadow-2xl border border-gray-100"><h2 class="text-3xl font-extrabold text-center mb-8">Account</h2><form action="/profile/update" method="POST" class="space-y-6 mb-10"><input value="{user['name']}" class="w-full p-4 rounded-2xl bg-gray-100" readonly><input name="new_pass" type="password" placeholder="New Password" class="w-full border p-4 rounded-2xl outline-none"><button class="w-full bg-indigo-600 text-white py-4 rounded-2xl font-extrabold transition-all active:scale-95">Save Profile</button></form>{addr_section}</div>''')
+                addr_list = address_rows(user['name'])
+                addresses = ADDRESS_SECTION.render(max=MAX_ADDRESSES, items=b''.join(ADDRESS_ITEM.render(id=a[0], text=a[1]) for a in addr_list),
+                                                   add_form=ADDRESS_ADD_FORM if len(addr_list) < MAX_ADDRESSES else b'')
+            self.send_html(get_header(user) + PROFILE_PAGE.render(name=user['name'], addresses=addresses))
 
         elif parsed_path.path == '/logout':
-            self.send_response(302); self.send_header('Set-Cookie', 'user=; Max-Age=0; Path=/'); self.send_header('Location', '/'); self.end_headers()
+            token = self.session_token()
+            if token: end_sessions(token=token)
+            self.send_response(302); self.send_header('Set-Cookie', 'sid=; Max-Age=0; Path=/'); self.send_header('Location', '/'); self.send_header('Content-Length', '0'); self.end_headers()
 
         elif parsed_path.path == '/admin/delete':
              if user and user['role'] == 'admin':
                 pid = query_params.get('id', [None])[0]
-                conn = sqlite3.connect(DB_PATH); conn.execute("DELETE FROM products WHERE id=?", (pid,)); conn.commit(); conn.close()
+                with transaction() as conn:
+                    conn.execute("DELETE FROM products WHERE id=?", (pid,)); version = catalog_version(conn)
+                RESPONSE_CACHE.invalidate(version, pid)
              self.redirect('/admin')
              
         elif parsed_path.path == '/profile/address/delete':
             if user:
-                aid = query_params.get('id', [None])[0]
-                conn = sqlite3.connect(DB_PATH); conn.execute("DELETE FROM addresses WHERE id=? AND username=?", (aid, user['name'])); conn.commit(); conn.close()
+                aid = query_params.get('id', [''])[0]
+                aid = parse_id(aid)
+                if aid is not None: delete_address(user['name'], aid)
             self.redirect('/profile')
 
         elif parsed_path.path == '/cart/delete':
             if user:
-                pid = query_params.get('id', [None])[0]
-                conn = sqlite3.connect(DB_PATH); conn.execute("DELETE FROM carts WHERE product_id=? AND username=?", (pid, user['name'])); conn.commit(); conn.close()
+                pid = query_params.get('id', [''])[0]
+                pid = parse_id(pid)
+                if pid is not None: change_cart(user['name'], [(pid, 'set', 0)])
             self.redirect('/cart')
 
+        else: self.send_error(404)
+
     def do_POST(self):
-        length = int(self.headers.get('Content-Length', 0))
-        data = urllib.parse.parse_qs(self.rfile.read(length).decode())
         user_session = self.get_user()
+        # Bulk imports are parsed straight off the socket instead of being read into memory first
+        if urllib.parse.urlparse(self.path).path == '/admin/import': self.import_catalog(user_session); return
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        data = urllib.parse.parse_qs(body.decode())
 
         if self.path == '/register':
             u, p = data.get('user', [''])[0], data.get('pass', [''])[0]
-            conn = sqlite3.connect(DB_PATH)
-            try: conn.execute("INSERT INTO users (username, password, role) VALUES (?,?,?)", (u, p, 'customer')); conn.commit(); self.redirect('/login')
-            except: self.redirect('/register?error=exists')
-            finally: conn.close()
+            try: db().execute("INSERT INTO users (username, password, role) VALUES (?,?,?)", (u, p, 'customer')); self.redirect('/login')
+            except sqlite3.IntegrityError: self.redirect('/register?error=exists')
 
         elif self.path == '/login':
             u, p = data.get('user', [''])[0], data.get('pass', [''])[0]
-            conn = sqlite3.connect(DB_PATH); res = conn.execute("SELECT role FROM users WHERE username=? AND password=?", (u, p)).fetchone(); conn.close()
-            if res: self.send_response(302); self.send_header('Set-Cookie', f'user={u}; Path=/; HttpOnly'); self.send_header('Location', '/'); self.end_headers()
+            res = db().execute("SELECT role FROM users WHERE username=? AND password=?", (u, p)).fetchone()
+            if res: self.set_session(start_session(u), '/')
             else: self.redirect('/login?error=1')
 
         elif self.path == '/admin/update_item':
             if user_session and user_session['role'] == 'admin':
                 pid, pr, d = data.get('id', [''])[0], data.get('price', ['0'])[0], data.get('desc', [''])[0]
-                conn = sqlite3.connect(DB_PATH); conn.execute("UPDATE products SET price=?, description=? WHERE id=?", (float(pr), d, pid)); conn.commit(); conn.close()
+                with transaction() as conn:
+                    conn.execute("UPDATE products SET price=?, description=? WHERE id=?", (float(pr), d, pid)); version = catalog_version(conn)
+                RESPONSE_CACHE.invalidate(version, pid, text_changed=True)
             self.redirect('/admin')
 
         elif self.path == '/profile/update':
             if not user_session: self.redirect('/login'); return
             np = data.get('new_pass', [''])[0]
             if np:
-                conn = sqlite3.connect(DB_PATH); conn.execute("UPDATE users SET password=? WHERE username=?", (np, user_session['name'])); conn.commit(); conn.close()
+                db().execute("UPDATE users SET password=? WHERE username=?", (np, user_session['name']))
+                # A new password signs out every other device; this one gets a fresh session
+                end_sessions(username=user_session['name'])
+                self.set_session(start_session(user_session['name']), '/profile?success=1'); return
             self.redirect('/profile?success=1')
 
         elif self.path == '/profile/address/add':
             if not user_session: self.redirect('/login'); return
             addr = data.get('address', [''])[0]
-            conn = sqlite3.connect(DB_PATH)
-            count = conn.execute("SELECT count(*) FROM addresses WHERE username=?", (user_session['name'],)).fetchone()[0]
-            if count < 3: conn.execute("INSERT INTO addresses (username, address_text) VALUES (?, ?)", (user_session['name'], addr)); conn.commit()
-            conn.close(); self.redirect('/profile')
+            add_address(user_session['name'], addr)
+            self.redirect('/profile')
 
         elif self.path == '/profile/address/edit':
             if not user_session: self.redirect('/login'); return
             aid, addr = data.get('id', [''])[0], data.get('address', [''])[0]
-            conn = sqlite3.connect(DB_PATH); conn.execute("UPDATE addresses SET address_text=? WHERE id=? AND username=?", (addr, aid, user_session['name'])); conn.commit(); conn.close()
+            aid = parse_id(aid)
+            if aid is not None: edit_address(user_session['name'], aid, addr)
             self.redirect('/profile')
 
         elif self.path == '/cart/qty':
             if not user_session or user_session['role'] == 'admin': self.redirect('/'); return
-            pid, change = data.get('product_id', [''])[0], int(data.get('change', ['0'])[0])
-            conn = sqlite3.connect(DB_PATH)
-            conn.execute('UPDATE carts SET quantity = quantity + ? WHERE product_id = ? AND username = ?', (change, pid, user_session['name']))
-            conn.execute('DELETE FROM carts WHERE product_id = ? AND quantity < 1', (pid,))
-            conn.commit(); conn.close(); self.redirect('/cart')
+            pid, change = parse_id(data.get('product_id', [''])[0]), parse_id(data.get('change', ['0'])[0])
+            if pid is not None and change is not None: change_cart(user_session['name'], [(pid, 'change', change)])
+            self.redirect('/cart')
+
+        elif self.path == '/cart/batch':
+            if not user_session or user_session['role'] == 'admin': self.send_json({'error': 'login required'}, 401); return
+            try: changes = parse_cart_changes(json.loads(body))
+            except (ValueError, KeyError, TypeError): self.send_json({'error': 'expected {"changes": [{"product_id": int, "change" or "quantity": int}, ...]}'}, 400); return
+            change_cart(user_session['name'], changes)
+            self.send_json(cart_summary(user_session['name']))
 
         elif self.path == '/admin/add':
             if user_session and user_session['role'] == 'admin':
                 n, pr, i, d = data.get('name', [''])[0], data.get('price', ['0'])[0], data.get('img', [''])[0], data.get('desc', [''])[0]
-                conn = sqlite3.connect(DB_PATH); conn.execute("INSERT INTO products (name, price, img, description) VALUES (?,?,?,?)", (n, float(pr), i, d)); conn.commit(); conn.close()
+                with transaction() as conn:
+                    pid = conn.execute("INSERT INTO products (name, price, img, description) VALUES (?,?,?,?)", (n, float(pr), i, d)).lastrowid; version = catalog_version(conn)
+                RESPONSE_CACHE.invalidate(version, pid, added=True)
             self.redirect('/admin')
 
         elif self.path == '/cart/add':
             if not user_session or user_session['role'] == 'admin': self.redirect('/'); return
             pid = data.get('product_id', [''])[0]
-            conn = sqlite3.connect(DB_PATH)
-            existing = conn.execute('SELECT quantity FROM carts WHERE username = ? AND product_id = ?', (user_session['name'], pid)).fetchone()
-            if existing: conn.execute('UPDATE carts SET quantity = quantity + 1 WHERE username = ? AND product_id = ?', (user_session['name'], pid))
-            else: conn.execute('INSERT INTO carts (username, product_id, quantity) VALUES (?, ?, ?)', (user_session['name'], pid, 1))
-            conn.commit(); conn.close(); self.redirect('/cart')
+            pid = parse_id(pid)
+            if pid is not None: change_cart(user_session['name'], [(pid, 'change', 1)])
+            self.redirect('/cart')
+
+        else: self.send_error(404)
+
+    def send_body(self, body, content_type, status=200):
+        encoding = self.accepted_encoding() if len(body) >= COMPRESS_MIN else None
+        if encoding: body = compress(body, encoding)
+        self.send_response(status); self.send_header('Content-type', content_type); self.send_header('Vary', 'Accept-Encoding')
+        if encoding: self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body))); self.end_headers(); self.wfile.write(body)
+
+    def send_html(self, body):
+        self.send_body(body, 'text/html; charset=utf-8')
 
-    def send_html(self, content):
-        self.send_response(200); self.send_header('Content-type', 'text/html; charset=utf-8'); self.end_headers(); self.wfile.write(content.encode())
+    def send_json(self, obj, status=200):
+        self.send_body(json.dumps(obj).encode(), 'application/json', status)
+
+    def send_cached(self, user, render, search=False):
+        # For pages that only change when the catalog does. The body is cached per (path, query, role)
+        # and the per-user header is put in front of it on every hit. render() runs only on a miss and
+        # returns (body parts, product ids shown, is last page) or None when there is nothing to show.
+        url = urllib.parse.urlparse(self.path)
+        key = (url.path, url.query, user['role'] if user else None)
+        entry, version = RESPONSE_CACHE.get(key)
+        if not entry:
+            rendered = render()
+            if not rendered: return False
+            parts, product_ids, last_page = rendered
+            entry = RESPONSE_CACHE.put(key, b''.join(parts), version, product_ids, last_page, search)
+        header = get_header(user)
+        # gzip is preferred here because the cached deflate stream makes it nearly free; each
+        # encoding is a different representation, so it gets its own ETag
+        encoding = entry.deflated and self.accepted_encoding(('gzip',) + ENCODINGS)
+        etag = f'"{hashlib.blake2b(header, digest_size=8).hexdigest()}-{entry.etag}{"-" + encoding if encoding else ""}"'
+        if etag in [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304); self.send_header('ETag', etag); self.end_headers()
+            return True
+        if encoding == 'gzip': body = gzip_splice(header, entry.body, entry.deflated)
+        elif encoding: body = compress(header + entry.body, encoding)
+        else: body = header + entry.body
+        self.send_response(200); self.send_header('Content-type', 'text/html; charset=utf-8')
+        self.send_header('ETag', etag); self.send_header('Cache-Control', 'private, no-cache' if user else 'no-cache'); self.send_header('Vary', 'Cookie, Accept-Encoding')
+        if encoding: self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body))); self.end_headers()
+        self.wfile.write(body)
+        return True
+
+    def import_catalog(self, user):
+        # Refusals leave the upload unread, so the connection can't be reused after them
+        if not user or user['role'] != 'admin': self.send_json({'error': 'forbidden'}, 403); self.close_connection = True; return
+        if 'Content-Length' not in self.headers: self.send_json({'error': 'Content-Length required'}, 411); self.close_connection = True; return
+        remaining = int(self.headers['Content-Length'])
+        fmt = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query).get('format', [None])[0]
+        fmt = fmt if fmt in ('csv', 'jsonl') else 'jsonl' if 'json' in self.headers.get('Content-Type', '') else 'csv'
+        def lines():
+            nonlocal remaining
+            while remaining > 0:
+                line = self.rfile.readline(remaining)
+                if not line: break
+                remaining -= len(line); yield line
+        # One JSON object per line: {"error": ...} per bad row, {"progress": ...} per committed batch, then {"done": ...}
+        self.send_stream(((json.dumps({kind: info}) + '\n').encode() for kind, info in import_products(lines(), fmt)),
+                         'application/x-ndjson', chunk=1)
+        # A CSV the reader gave up on leaves the rest of the upload unread: drain it so the
+        # connection stays usable (closing on unread data would reset it, response and all)
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 65536))
+            if not chunk: self.close_connection = True; break
+            remaining -= len(chunk)
+
+    def send_stream(self, parts, content_type='text/html; charset=utf-8', headers=(), chunk=STREAM_CHUNK):
+        # The first part (the page header) goes out at once so the browser can start fetching CSS/JS;
+        # the rest is sent as HTTP/1.1 chunks of about STREAM_CHUNK bytes, so memory stays bounded.
+        # Compressed streams are sync-flushed at every chunk so the browser can render as they arrive.
+        chunked = self.request_version != 'HTTP/1.0'
+        encoding = self.accepted_encoding()
+        self.send_response(200); self.send_header('Content-type', content_type); self.send_header('Vary', 'Accept-Encoding')
+        for name, value in headers: self.send_header(name, value)
+        if encoding: self.send_header('Content-Encoding', encoding)
+        if chunked: self.send_header('Transfer-Encoding', 'chunked')
+        else: self.send_header('Connection', 'close'); self.close_connection = True
+        self.end_headers()
+        feed, finish = compressor(encoding) if encoding else (None, None)
+        buf, size = [], 0
+        def write(data):
+            if not data: return  # an empty chunk would end the response
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data) if chunked else data)
+        def flush():
+            data = b''.join(buf); buf.clear()
+            if data: write(feed(data) if feed else data)
+        for i, data in enumerate(parts):
+            buf.append(data); size += len(data)
+            if i == 0 or size >= chunk: flush(); size = 0
+        if buf: flush()
+        if finish: write(finish())
+        if chunked: self.wfile.write(b'0\r\n\r\n')
 
     def redirect(self, path):
-        self.send_response(302); self.send_header('Location', path); self.end_headers()
+        self.send_response(302); self.send_header('Location', path); self.send_header('Content-Length', '0'); self.end_headers()
 
-if __name__ == "__main__":
+# --- SERVER ---
+class PooledServer(socketserver.TCPServer):
+    allow_reuse_address = True
+    request_queue_size = QUEUE_SIZE
+
+    def __init__(self, address, handler, workers=WORKERS, queue_size=QUEUE_SIZE, reuse_port=False):
+        self.reuse_port = reuse_port
+        super().__init__(address, handler)
+        self.jobs = queue.Queue(queue_size)
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for t in self.workers: t.start()
+
+    def server_bind(self):
+        if self.reuse_port: self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        # Backpressure: never queue more than queue_size connections, shed the rest immediately
+        try: self.jobs.put_nowait((request, client_address))
+        except queue.Full:
+            try: request.sendall(b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            except OSError: pass
+            self.shutdown_request(request)
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None: return
+            request, client_address = job
+            try: self.finish_request(request, client_address)
+            except Exception: self.handle_error(request, client_address)
+            finally: self.shutdown_request(request)
+
+    def server_close(self):
+        # Graceful: stop listening, let workers finish everything already queued, then join them
+        super().server_close()
+        for _ in self.workers: self.jobs.put(None)
+        for t in self.workers: t.join()
+        if WRITE_QUEUE: WRITE_QUEUE.close()
+        close_pool()
+
+def run_server(port=PORT, workers=WORKERS, reuse_port=False):
+    server = PooledServer(("", port), ShopHandler, workers, reuse_port=reuse_port)
+    stop = lambda signum, frame: threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop); signal.signal(signal.SIGINT, stop)
+    try: server.serve_forever()
+    finally: server.server_close()
+
+def serve(port=PORT, workers=WORKERS, processes=PROCESSES):
+    if processes <= 1: run_server(port, workers); return
+    children = []
+    for _ in range(processes):
+        pid = os.fork()
+        if pid == 0:
+            try: run_server(port, workers, reuse_port=True)
+            finally: os._exit(0)
+        children.append(pid)
+
+    def stop(signum, frame):
+        for pid in children:
+            try: os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError: pass
+    signal.signal(signal.SIGTERM, stop); signal.signal(signal.SIGINT, stop)
+    for pid in children: os.waitpid(pid, 0)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Shop server and catalog tools.')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('serve', help='initialise the database and serve (the default)')
+    commands.add_parser('init', help='create or migrate the database, then exit')
+    cmd = commands.add_parser('import', help='load products from CSV or JSONL')
+    cmd.add_argument('file', help='path, or - for stdin')
+    cmd.add_argument('--format', choices=('csv', 'jsonl'), help='default: from the file extension, else csv')
+    cmd = commands.add_parser('export', help='write all products as CSV or JSONL')
+    cmd.add_argument('--format', choices=('csv', 'jsonl'), help='default: from the output extension, else csv')
+    cmd.add_argument('-o', '--output', default='-', help='path, or - for stdout (the default)')
+    args = parser.parse_args(argv)
     init_db()
-    print(f" Running at http://localhost:{PORT}")
-    socketserver.TCPServer(("", PORT), ShopHandler).serve_forever()
\ No newline at end of file
+    if args.command == 'init': return
+    if args.command == 'import':
+        fmt = args.format or catalog_format(args.file)
+        with (open(args.file, 'rb') if args.file != '-' else contextlib.nullcontext(sys.stdin.buffer)) as f:
+            for kind, info in import_products(f, fmt):
+                if kind == 'error': print(f"line {info['line']}: {info['message']}", file=sys.stderr)
+                else: print(f"{kind}: {info['imported']} of {info['rows']} rows imported, {info['failed']} failed", file=sys.stderr)
+        return
+    if args.command == 'export':
+        fmt = args.format or catalog_format(args.output)
+        with (open(args.output, 'wb') if args.output != '-' else contextlib.nullcontext(sys.stdout.buffer)) as f:
+            for part in export_products(fmt): f.write(part)
+        return
+    print(f" Running at http://localhost:{PORT} ({PROCESSES} process(es) x {WORKERS} workers)")
+    serve()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file